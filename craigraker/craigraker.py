@@ -2,9 +2,12 @@
 import argparse
 import asyncio
 import configparser
+import sys
+from contextlib import ExitStack
 from os.path import expanduser, exists
 
 from craigraker_functions import *
+from craigraker_progress import Progress, progress_bar
 
 """
 
@@ -26,17 +29,30 @@ https://github.com/ethan626
 
 """
 
-LOOP = asyncio.get_event_loop()
-
-
 def main():
     """ Call this to start Craigraker """
-    parser = argparse.ArgumentParser()
+    if sys.argv[1:2] == ["query"]:  # Search the ads stored with --store instead of craigslist
+        return query_main(sys.argv[2:])
+
+    if sys.argv[1:2] == ["serve"]:  # Keep running, taking searches over a local JSON API
+        from craigraker_serve import serve_main
+        return serve_main(sys.argv[2:])
+
+    if sys.argv[1:2] == ["worker"]:  # Run jobs from a --queue
+        from craigraker_worker import worker_main
+        return worker_main(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(epilog="Run craigraker query --help to search the ads kept with --store, \
+                                                    and craigraker serve --help to keep craigraker running as a local JSON API")
     parser.add_argument("-q", "--query", help="The search term, if there are spaces this must be surrounded \
                                               by quotes or escaped with \. Example \"this search has spaces\" ")
     parser.add_argument("-Q", "--quiet", help="Do not print output", action="store_true")
     parser.add_argument("-F", "--file", help="The file to which Craigraker will write the output. \
                                              If the file exists Craigraker will append to the end of the file")
+    parser.add_argument("--store", help="Keep every ad in the local store, to search later with craigraker query", action="store_true")
+    parser.add_argument("--format", choices=["csv", "ndjson", "parquet"], help="The format of --file. \
+                                                                              Guessed from the file extension if not given, otherwise csv. \
+                                                                              parquet needs pyarrow installed")
     parser.add_argument("-f", "--firstpage", help="Only scrape the first page of the search results", action="store_true")
     parser.add_argument("-P", "--sortpricemax", help="Turn on sort by price with the maximum price first", action="store_true")
     parser.add_argument("-p", "--sortpricemin", help="Turn on sort by price with the minimum price first", action="store_true")
@@ -44,9 +60,22 @@ def main():
     parser.add_argument("-d", "--sortpast", help="Sort by date posted with the most recent last", action="store_true")
     parser.add_argument("-S", "--donotsort", help="Do not sort. Overrides local config.", action="store_true")
     parser.add_argument("-D", "--sortrecent", help="Sort by date posted with the most recent first", action="store_true")
+    parser.add_argument("--sortby", metavar="EXPR", help="Sort by an expression of the ad's fields, such as \"price / 10 + age(posted)\". \
+                                                         Overrides local config")
+    parser.add_argument("--reverse", help="Sort --sortby from largest to smallest", action="store_true")
+    parser.add_argument("--filter", metavar="EXPR", help="Only keep ads for which an expression is true, such as \
+                                                        \"price < 500 and 'trek' in lower(title)\". Price bounds are also sent to craigslist")
+    parser.add_argument("--minprice", type=int, help="Have craigslist only return ads priced at least this")
+    parser.add_argument("--maxprice", type=int, help="Have craigslist only return ads priced at most this")
+    parser.add_argument("--postedtoday", help="Have craigslist only return ads posted today", action="store_true")
+    parser.add_argument("--hasimage", help="Have craigslist only return ads with pictures", action="store_true")
+    parser.add_argument("--titleonly", help="Have craigslist only match the query against the titles of ads", action="store_true")
     parser.add_argument("-a", "--allresults", help="Search all pages. \
                                                    If not specified, just the first page of 120 results will be returned", action="store_true")
-    parser.add_argument("-m", "--maxresults", help="The maximum number of results to display")
+    parser.add_argument("-m", "--maxresults", help="The maximum number of results to scrape and display for each search. \
+                                                    Sorting orders the ones scraped, and with --batch keeps the best across the searches")
+    parser.add_argument("--sortmemory", type=int, help="Megabytes of results to sort in memory, \
+                                                       past that sorted runs are written to temporary files and merged")
     parser.add_argument("-c", "--color", help="Color the output - uses ansi colors. ", action="store_true")
     parser.add_argument("-w", "--where", help="Which Craigslist location to use.")
     parser.add_argument("-W", "--sublocation", help="Which sublocation to use")
@@ -55,6 +84,47 @@ def main():
                                                   The date returned will be the date the ad was posted""",
                                                 action="store_true")
     parser.add_argument("-i", "--ignorewanted", help="Ignore ads with \"wanted\" in the title.", action="store_true")
+    parser.add_argument("--eagercontacts", help="With --verbose and sorting, look up the contact details of every ad as it is \
+                                                scraped, instead of only those of the sorted ads that are output", action="store_true")
+    parser.add_argument("--adconcurrency", type=int, default=20, help="The maximum number of ad pages fetched at once with --verbose")
+    parser.add_argument("--maxrequests", type=int, help="The maximum number of requests in flight at once")
+    parser.add_argument("--maxperhost", type=int, help="The maximum number of requests in flight to a single Craigslist host")
+    parser.add_argument("--rate", type=float, help="The maximum number of requests per second to a single Craigslist host, 0 for no limit")
+    parser.add_argument("--noadaptive", help="Keep the per host request window fixed at --maxperhost \
+                                             instead of adapting it to latency and throttling", action="store_true")
+    parser.add_argument("--connecttimeout", type=float, help="Seconds to wait for a connection to craigslist, 0 to wait forever")
+    parser.add_argument("--readtimeout", type=float, help="Seconds to wait for craigslist to send more of a page, 0 to wait forever")
+    parser.add_argument("--retries", type=int, help="How many times a request that timed out or was throttled is retried")
+    parser.add_argument("--hedge", type=float, metavar="SECONDS", help="Request a search page a second time if it has not \
+                                                                      arrived after SECONDS, and use whichever copy arrives first")
+    parser.add_argument("--failures", metavar="FILE", help="Append the pages that could not be scraped to FILE, one json object per line")
+    parser.add_argument("--nocache", help="Do not read or write the on-disk response cache", action="store_true")
+    parser.add_argument("--watch", type=float, metavar="INTERVAL", help="Keep scraping every INTERVAL seconds, \
+                                                                      only showing ads that are new or have been updated")
+    parser.add_argument("--newonly", help="Only show ads that are new or have been updated since the last --newonly or --watch run \
+                                          of the same search", action="store_true")
+    parser.add_argument("--nodedupe", help="Keep ads found more than once in a run, such as cross-posts to nearby areas \
+                                           and reposts with the same title, price and location", action="store_true")
+    parser.add_argument("--parser", choices=["lxml", "soup"], help="The html parser to use, lxml (the default) is the fastest")
+    parser.add_argument("--parseworkers", type=int, help="Parse pages in this many worker processes instead of on the event loop, \
+                                                         0 to parse inline")
+    parser.add_argument("--batch", metavar="JOBFILE", help="Run every search listed in JOBFILE at once. \
+                                                          Each row of output starts with the name of the search it came from")
+    parser.add_argument("--jobconcurrency", type=int, help="The maximum number of requests in flight for each search of a --batch")
+    parser.add_argument("--queue", help="Put the searches of a --batch on this work queue and collect what the workers find, \
+                                        instead of scraping here. Workers are started with craigraker worker --queue QUEUE")
+    parser.add_argument("--workers", type=int, help="Start this many worker processes on this machine for --queue, \
+                                                    which is a queue in ~/.cache/craigraker if not given")
+    parser.add_argument("--stats", nargs="?", const="-", metavar="FILE", help="Print a json summary of request, parse and \
+                                                                          contact lookup times, bytes, cache hits, retries and errors \
+                                                                          at the end of the run, or write it to FILE")
+    parser.add_argument("--prometheus", metavar="FILE", help="Write the same measurements to FILE in the Prometheus text format, \
+                                                             after every round of --watch")
+    parser.add_argument("--metricsport", type=int, help="Serve the measurements for Prometheus on http://127.0.0.1:PORT/metrics while running")
+    parser.add_argument("--profile", metavar="FILE", help="Profile the run. Writes cProfile stats to FILE (read them with python -m pstats), \
+                                                          or a pyinstrument report if FILE ends in .html")
+    parser.add_argument("--progress", help="Show a progress bar, with the pages and ads done and the time left", action="store_true")
+    parser.add_argument("--debug", help="Print the traceback of every error", action="store_true")
     parser.add_argument("-s", "--section", help="Which section to search in, for example \"forsale\" or \"personals\"")
     args = parser.parse_args()
 
@@ -63,7 +133,11 @@ def main():
 
     if not exists(expanduser("~/.craigrakerrc")):  # if path does not exist, create the config file in the home directory
         config["DEFAULT"] = {"city": "seattle", "sublocation": "", "section": "",
-                             "maxresults": 2500, "firstpage": False, "sort": False}
+                             "maxresults": 2500, "firstpage": False, "sort": False,
+                             "maxrequests": 50, "maxperhost": 10, "rate": 0, "adaptive": True,
+                             "connecttimeout": 10, "readtimeout": 30, "retries": 3, "hedge": 0, "dedupe": True,
+                             "sortmemory": 256, "store": False,
+                             "cache": True, "cachesize": 200, "parser": "lxml", "parseworkers": 0}
 
         with open(expanduser("~/.craigrakerrc"), "w+") as configfile:
             config.write(configfile)
@@ -89,13 +163,30 @@ def main():
     if not args.section:        # Default to for sale
         section = "sss?"
 
-    local_cl_url = "https://" + city + ".craigslist.org" + sublocation
+    search_url, local_cl_url = search_urls(city, sublocation, section)
 
-    if sublocation:
-        search_url = "https://" + city + ".craigslist.org/search/" + sublocation + "/" + section
+    """ Request limits, the command line overrides the config file. """
+    configure_network(max_requests=args.maxrequests or config["DEFAULT"].getint("maxrequests", 50),
+                      max_per_host=args.maxperhost or config["DEFAULT"].getint("maxperhost", 10),
+                      rate=args.rate if args.rate is not None else config["DEFAULT"].getfloat("rate", 0),
+                      adaptive=not args.noadaptive and config["DEFAULT"].getboolean("adaptive", True))
+
+    configure_session(connect_timeout=args.connecttimeout if args.connecttimeout is not None
+                      else config["DEFAULT"].getfloat("connecttimeout", 10),
+                      read_timeout=args.readtimeout if args.readtimeout is not None else config["DEFAULT"].getfloat("readtimeout", 30))
+
+    configure_retries(retries=args.retries if args.retries is not None else config["DEFAULT"].getint("retries", 3),
+                      hedge=args.hedge if args.hedge is not None else config["DEFAULT"].getfloat("hedge", 0))
+
+    configure_cache(enabled=not args.nocache and config["DEFAULT"].getboolean("cache", True),
+                    max_bytes=config["DEFAULT"].getint("cachesize", 200) * 1024 * 1024)  # Cache size is in megabytes
+
+    try:
+        configure_parser(backend=args.parser or config["DEFAULT"].get("parser", "lxml"),
+                         workers=args.parseworkers if args.parseworkers is not None else config["DEFAULT"].getint("parseworkers", 0))
 
-    else:
-        search_url = "https://" + city + ".craigslist.org/search/" + section
+    except ValueError as e:     # An unknown parser in the config file
+        parser.error(str(e))
 
     if args.maxresults:
         max_results = int(args.maxresults)
@@ -109,19 +200,19 @@ def main():
         max_results = 120
 
     if args.sortlocation:
-        sort = {"key": lambda x: x[2]}
+        sort = {"field": "hood"}
 
     if args.sortpricemin:
-        sort = {"key": lambda x: x[1]}
+        sort = {"field": "price"}
 
     if args.sortpricemax:
-        sort = {"key": lambda x: x[1], "reverse": True}
+        sort = {"field": "price", "reverse": True}
 
     if args.sortpast:
-        sort = {"key": lambda x: x[-1]}
+        sort = {"field": "posted" if args.verbose else "updated"}
 
     if args.sortrecent:
-        sort = {"key": lambda x: x[-1], "reverse": True}
+        sort = {"field": "posted" if args.verbose else "updated", "reverse": True}
 
     if args.donotsort:
         sort = dict()
@@ -129,49 +220,255 @@ def main():
     if args.donotsort:
         sort = False
 
+    if args.sortby:
+        sort = {"field": args.sortby, "reverse": args.reverse}
+
     if not args.sortlocation and not args.sortpricemin \
         and not args.sortpricemax and not args.sortpast \
-            and not args.sortrecent and not args.donotsort:
-        if config["DEFAULT"]["sort"].lower() == "false":
+            and not args.sortrecent and not args.donotsort and not args.sortby:
+        if config["DEFAULT"].get("sort", "false").lower() == "false":
             sort = False
 
+        else:                   # An expression, see craigraker_expr.py
+            sort = {"field": config["DEFAULT"]["sort"], "reverse": config["DEFAULT"].getboolean("reverse", False)}
+
+    where = args.filter or config["DEFAULT"].get("filter") or None
+
+    try:                        # Expressions are checked and compiled once, before anything is fetched
+        if sort and sort["field"] not in FIELDS:
+            sort["field"] = compile_expression(sort["field"])
+
+        row_filter.set(compile_expression(where) if where else None)
+
+    except ValueError as e:
+        parser.error(str(e))
+
+    if row_filter.get() is not None and row_filter.get().late and not args.verbose and not args.batch:  # Jobs are checked by load_jobs
+        parser.error("--filter uses {} from the ad page, which needs --verbose".format(", ".join(
+            field for field in row_filter.get().fields if field not in SEARCH_FIELDS)))
+
+    filter_options = {"min_price": args.minprice if args.minprice is not None else config["DEFAULT"].getint("minprice"),
+                      "max_price": args.maxprice if args.maxprice is not None else config["DEFAULT"].getint("maxprice"),
+                      "posted_today": args.postedtoday or config["DEFAULT"].getboolean("postedtoday", False),
+                      "has_image": args.hasimage or config["DEFAULT"].getboolean("hasimage", False),
+                      "title_only": args.titleonly or config["DEFAULT"].getboolean("titleonly", False)}
+    filters = search_filters(where=row_filter.get(), **filter_options)  # Done by craigslist, so fewer pages are fetched
+
+    dedupe = None if not args.nodedupe and config["DEFAULT"].getboolean("dedupe", True) else False  # None for a new one each run
+
+    failures = []               # Pages that could not be scraped, even after retrying
+    failure_log.set(failures)
+    DEBUG["tracebacks"] = args.debug
+    # Unsorted rows are output as they come, so there is nothing to skip. Sorting or filtering on them needs every contact
+    CONTACTS["eager"] = args.eagercontacts or not sort or uses_contacts(sort["field"]) \
+        or row_filter.get() is not None and row_filter.get().contacts
+    running = ExitStack()       # Things to stop once the run is over
+    loop = get_loop()
+
+    if args.profile:
+        try:
+            running.enter_context(profiled(args.profile))
+
+        except ValueError as e:  # An html profile without pyinstrument
+            parser.error(str(e))
+
+    if args.metricsport:
+        metrics = loop.run_until_complete(start_metrics_server(args.metricsport))
+        running.callback(lambda: loop.run_until_complete(metrics.cleanup()))
+
+    store = None
+
+    if args.store or config["DEFAULT"].getboolean("store", False):
+        try:
+            store = AdStore()
+
+        except ValueError as e:  # An sqlite without full-text search
+            parser.error(str(e))
+
+        running.callback(store.close)
+
+    def report():               # After every round
+        if failures and not args.quiet:
+            print("{} pages could not be scraped".format(len(failures)))
+
+        if failures and args.failures:
+            write_failures(args.failures, failures)
+
+        failures.clear()
+
+        if args.prometheus:
+            get_stats().write_prometheus(args.prometheus)
+
+    def track():                # Before every round
+        if args.progress:
+            progress_tracker.set(Progress(progress_bar()))
+
+    def untrack():
+        if progress_tracker.get() is not None:
+            progress_tracker.get().finish()
+
+    def show(row):
+        if args.progress:       # Print the row over the progress bar, it is drawn again on the next line
+            sys.stderr.write("\r\033[K")
+
+        print(print_result(row, color=args.color), flush=True)
+
+    def finish():
+        running.close()
+
+        if args.stats:
+            get_stats().write_json(args.stats)
+
+        close_all()
+        loop.close()            # Close asyncio event loop
+
+    def new_sorter(ad=None):
+        """ With --maxresults only the best max_results rows are kept, across every search of a --batch. A single search
+            is already cut to max_results as it is scraped. """
+        return Sorter(sort["field"], reverse=sort.get("reverse", False), limit=max_results if args.maxresults else None,
+                      memory=args.sortmemory or config["DEFAULT"].getint("sortmemory", 256), ad=ad)
+
+    if args.batch:              # Many searches at once, then we are done
+        try:
+            jobs = load_jobs(args.batch, max_results=max_results, verbose=args.verbose, wanted=args.ignorewanted,
+                             filters=filter_options, where=where)
+
+        except (ValueError, configparser.Error) as e:
+            parser.error(str(e))
+
+        if any(job["where"] and compile_expression(job["where"]).contacts for job in jobs):
+            CONTACTS["eager"] = True
+
+        if args.queue or args.workers:  # Scraped by worker processes instead
+            from craigraker_worker import QUEUE_PATH, open_queue, submit, collect, start_workers
+
+            queue = open_queue(args.queue or QUEUE_PATH)
+            running.callback(queue.close)
+            results = collect(queue, submit(queue, jobs, dedupe=dedupe), dedupe=dedupe)
+
+            for worker in start_workers(args.queue or QUEUE_PATH, args.workers or 0):
+                running.callback(worker.wait)       # They stop once the queue is empty
+
         else:
-            try:
-                sort = exec(config["DEFAULT"]["sort"])
+            results = iter_batch(jobs, ad_concurrency=args.adconcurrency, job_concurrency=args.jobconcurrency, dedupe=dedupe)
+
+        try:
+            writer = open_writer(args.file, format=args.format, tagged=True) if args.file else None
+
+        except ValueError as e:
+            parser.error(str(e))
+
+        def output(item):
+            name, result = item
+
+            if not args.quiet:
+                show([name] + list(result))
+
+            if writer:
+                writer.write(result, source=name)
+
+            if store is not None:
+                store.write(result, source=name)
+
+        sorter = new_sorter(ad=lambda item: item[1]) if sort else None  # Sorts the rows of every search together
+
+        try:
+            track()
+            loop.run_until_complete(consume(results, sorter.add if sorter is not None else output))
+            untrack()
+
+            for item in with_contacts(sorter, ad=lambda item: item[1]) if sorter is not None else ():
+                output(item)
+
+        finally:
+            if sorter is not None:
+                sorter.close()
 
-            except Exception:
-                print("Sort found in config file is not valid. ")
-                sort = False
+            if writer:
+                writer.close()
+
+            report()
+
+        finish()
+        return
+
+    if args.queue or args.workers:
+        parser.error("--queue and --workers are for the searches of a --batch")
 
     """ This section is where we scrape CL """
-    try:
-        results = [result for result in scrape(search_url,
-                                               local_cl_url,
-                                               args.query,
-                                               max_results=max_results,
-                                               verbose=args.verbose,
-                                               wanted=args.ignorewanted)]
+    index = None
+
+    if args.watch or args.newonly:  # Remember which ads we have seen so only new or updated ads are fetched and shown
+        index = SeenIndex(search_url + "?query=" + str(args.query) + "".join("&{}={}".format(*item) for item in sorted(filters.items())))
+
+    if args.watch:              # Search pages must be rechecked every round rather than served from the cache
+        configure_cache(ttl={"search": 0})
+
+    try:                        # One writer for the whole run, rows are buffered and written in batches
+        writer = open_writer(args.file, format=args.format) if args.file else None
+
+    except ValueError as e:
+        parser.error(str(e))
+
+    def output(result):
+        if not args.quiet:
+            show(result)
+
+        if writer:
+            writer.write(result)
+
+        if store is not None:
+            store.write(result, source=args.query)
+
+    while True:
+        sorter = new_sorter() if sort else None  # Sorting needs every result, so they are collected before printing
+
+        try:                    # Without sorting each result is printed and written as soon as it is scraped
+            track()
+            loop.run_until_complete(consume(iter_scrape(search_url,
+                                                        local_cl_url,
+                                                        args.query,
+                                                        max_results=max_results,
+                                                        verbose=args.verbose,
+                                                        wanted=args.ignorewanted,
+                                                        ad_concurrency=args.adconcurrency,
+                                                        index=index,
+                                                        dedupe=dedupe,
+                                                        filters=filters),
+                                            sorter.add if sorter is not None else output))
+            untrack()
+
+            for result in with_contacts(sorter) if sorter is not None else ():
+                output(result)
+
+        finally:
+            if sorter is not None:
+                sorter.close()
+
+            if writer:          # Everything from this round is on disk before we wait for the next
+                writer.flush()
+
+            if store is not None:
+                store.flush()
+
+        report()
 
-    except TypeError as e:      # Most likely caused by results being None and thus not iterable. No results will be printed later in the script
-        results = []  # No results. Variable name is referenced later so we need results in scope
+        if not args.watch:
+            break
 
-    if sort:
-        results.sort(**sort)
+        try:                    # Wait on the same event loop so the pooled connections can be reused next round
+            loop.run_until_complete(asyncio.sleep(args.watch))
 
-    if not args.quiet and len(results) > 0:
-        print_result(['Title', 'Price', 'Location', 'Posting Information',
-                      'Email', 'Phone', 'Url', 'Updated', 'Posted'], color=args.color)  # Headers for csv columns
+        except KeyboardInterrupt:
+            break
 
-        for result in results:
-            print(print_result(result, color=args.color))
+    if index is not None:
+        index.close()
 
-    if args.file:
-        with open(args.file, 'a+') as f:
-            for result in results:
-                f.write(print_result(result))
-                f.write('\n')
+    if writer:
+        writer.close()
 
-    LOOP.close()                # Close asyncio event loop
+    finish()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,294 @@
+#!/bin/python
+import argparse
+import asyncio
+import json
+import multiprocessing
+import resource
+import socket
+import subprocess
+import sys
+import time
+from aiohttp import web
+from os.path import abspath, dirname, exists
+
+import craigraker_functions as functions
+from craigraker_cache import resource_type
+
+"""
+
+Craigraker! A really cool Craigslist scraper! Benchmarks!
+
+Measures craigraker without touching the real craigslist. A local stand-in server is started
+in its own process, serving synthetic search pages (span.totalcount, p.result-info, paging with s=),
+ad pages and reply pages with a chosen number of results and latency. scrape, which collects the
+same iter_scrape the CLI runs, is then run against it.
+
+Reports pages/s, ads/s, p50/p99 request latency, peak RSS and how the time split between
+network and parsing. Results can be saved as a baseline and later runs compared against it.
+
+--startup measures how long importing craigraker takes instead, in fresh interpreters, and checks that
+the heavy dependencies in LAZY_MODULES are only imported once they are used.
+
+Example usage:
+
+python craigraker_bench.py --results 2500 --latency 50 --verbose --save baseline.json
+python craigraker_bench.py --results 2500 --latency 50 --verbose --compare baseline.json
+python craigraker_bench.py --startup --compare startup.json
+
+Author: Ethan Henderson
+https://github.com/ethan626
+
+"""
+
+SEARCH_PATH = "/search/sss"
+
+LAZY_MODULES = ("aiohttp", "lxml", "bs4", "dateutil", "termcolor", "gooey", "cProfile", "pyarrow", "pyinstrument")
+
+
+""" The stand-in craigslist server """
+
+
+def search_ad(port, i):
+    """ One p.result-info, shaped like the ones on a craigslist search page. """
+    return ('<li class="result-row"><a href="/ad/{i}.html" class="result-image gallery"></a>'
+            '<p class="result-info"><span class="icon icon-star" role="button"></span>'
+            '<time class="result-date" datetime="2019-{month:02d}-{day:02d} {hour:02d}:{minute:02d}">Jan {day}</time>'
+            '<a href="http://127.0.0.1:{port}/ad/{i}.html" data-id="{id}" class="result-title hdrlnk">Item number {i}{wanted}</a>'
+            '<span class="result-meta"><span class="result-price">${price}</span>'
+            '<span class="result-hood"> (Neighborhood {hood})</span>'
+            '<span class="result-tags">pic<span class="maptag" data-pid="{id}">map</span></span></span></p></li>\n'
+            ).format(i=i, port=port, id=6000000000 + i, month=1 + i % 12, day=1 + i % 28, hour=i % 24, minute=i % 60,
+                     price=(i * 37) % 5000, hood=i % 40, wanted=" wanted" if i % 25 == 0 else "")
+
+
+def search_page(port, total, start):
+    ads = "".join(search_ad(port, i) for i in range(start, min(start + 120, total)))
+
+    return ('<!DOCTYPE html><html><head><title>for sale - craigslist</title></head><body>'
+            '<div class="search-legend"><span class="rangeFrom">{first}</span> - <span class="rangeTo">{last}</span> '
+            '/ <span class="totalcount">{total}</span></div><ul class="rows">\n{ads}</ul></body></html>'
+            ).format(first=start + 1, last=min(start + 120, total), total=total, ads=ads)
+
+
+def ad_page(i, text_size):
+    body = ("Selling item number {}, works great. ".format(i) * (text_size // 36 + 1))[:text_size]
+
+    return ('<!DOCTYPE html><html><body><section class="body"><h2 class="postingtitle">Item number {i}</h2>'
+            '<button class="reply-button"><a id="replylink" href="/reply/{i}">reply</a></button>'
+            '<section id="postingbody">\n\nQR Code Link to This Post\n\n\n{body}\n</section>'
+            '<p class="postinginfo">posted: <time class="date timeago" datetime="2019-01-01T10:00:00-0800">2019-01-01 10:00</time></p>'
+            '</section></body></html>').format(i=i, body=body)
+
+
+def reply_page(i):
+    return ('<!DOCTYPE html><html><body><div class="reply-info"><p class="anonemail">{i}@sale.craigslist.org</p>'
+            '<p class="reply-tel-number">(555) 000-{i:04d}</p></div></body></html>').format(i=i % 10000)
+
+
+def serve(port, total, latency, text_size, ready):
+    """ Runs the stand-in server until the process is terminated. latency is in seconds. """
+    async def delay():
+        if latency:
+            await asyncio.sleep(latency)
+
+    async def search(request):
+        await delay()
+        return web.Response(text=search_page(port, total, int(request.query.get("s", 0))), content_type="text/html")
+
+    async def ad(request):
+        await delay()
+        return web.Response(text=ad_page(int(request.match_info["i"]), text_size), content_type="text/html")
+
+    async def reply(request):
+        await delay()
+        return web.Response(text=reply_page(int(request.match_info["i"])), content_type="text/html")
+
+    app = web.Application()
+    app.router.add_get(SEARCH_PATH, search)
+    app.router.add_get("/ad/{i}.html", ad)
+    app.router.add_get("/reply/{i}", reply)
+
+    async def start():
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        ready.set()
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(start())
+    loop.run_forever()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(total, latency, text_size):
+    """ Starts the stand-in server in its own process. Returns (process, base url). """
+    port = free_port()
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(port, total, latency, text_size, ready), daemon=True)
+    server.start()
+
+    if not ready.wait(10):
+        server.terminate()
+        raise RuntimeError("The benchmark server did not start")
+
+    return server, "http://127.0.0.1:{}".format(port)
+
+
+""" Measuring """
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+def timed(function, samples):
+    """ Wraps a coroutine function so the time each call takes is appended to samples. """
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+
+        try:
+            return await function(*args, **kwargs)
+
+        finally:
+            samples.append(time.perf_counter() - started)
+
+    return wrapper
+
+
+def run(total=1200, latency=0.02, text_size=2000, verbose=False, max_results=2500, ad_concurrency=20, parser=None):
+    """ Runs one benchmark and returns its measurements as a dict. """
+    server, base_url = start_server(total, latency, text_size)
+    fetch, parse_async = functions.fetch, functions.parse_async
+    fetch_times, parse_times, kinds = [], [], []
+
+    async def counted_fetch(url, params=None, **kwargs):
+        kinds.append(resource_type(url))
+        return await fetch(url, params=params, **kwargs)
+
+    functions.fetch = timed(counted_fetch, fetch_times)
+    functions.parse_async = timed(parse_async, parse_times)
+    functions.configure_cache(enabled=False)  # Every request has to reach the server
+
+    if parser:
+        functions.configure_parser(backend=parser)
+
+    try:
+        started = time.perf_counter()
+        results = functions.scrape(base_url + SEARCH_PATH, base_url, "bench", max_results=max_results, verbose=verbose,
+                                   ad_concurrency=ad_concurrency)
+        elapsed = time.perf_counter() - started
+
+    finally:
+        functions.fetch, functions.parse_async = fetch, parse_async
+        functions.get_loop().run_until_complete(functions.close_session())
+        server.terminate()
+
+    pages = kinds.count("search")
+
+    return {"results": total, "latency_ms": latency * 1000, "verbose": verbose,
+            "rows": len(results or []),
+            "seconds": round(elapsed, 3),
+            "requests": len(kinds),
+            "pages_per_second": round(pages / elapsed, 2),
+            "ads_per_second": round(len(results or []) / elapsed, 2),
+            "p50_ms": round(percentile(fetch_times, 0.5) * 1000, 2),
+            "p99_ms": round(percentile(fetch_times, 0.99) * 1000, 2),
+            "network_seconds": round(sum(fetch_times), 3),  # Summed over concurrent requests, so it can exceed seconds
+            "parse_seconds": round(sum(parse_times), 3),
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+
+
+def startup(runs=10):
+    """ Times importing craigraker.py in fresh interpreters, less the time a bare interpreter takes to start.
+        Returns the fastest of runs, and the LAZY_MODULES that were imported anyway. """
+    here = dirname(abspath(__file__))
+    script = ("import sys, time; started = time.perf_counter(); import craigraker; "
+              "print(time.perf_counter() - started, *[m for m in {!r} if m in sys.modules])").format(LAZY_MODULES)
+
+    def run_python(code):
+        started = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", code], cwd=here, check=True, capture_output=True, text=True).stdout.split()
+        return time.perf_counter() - started, output
+
+    bare = min(run_python("pass")[0] for _ in range(runs))
+    timings = [run_python(script) for _ in range(runs)]
+
+    return {"import_ms": round(min(float(output[0]) for _, output in timings) * 1000, 2),
+            "startup_ms": round(max(0, min(elapsed for elapsed, _ in timings) - bare) * 1000, 2),
+            "eager_imports": sorted(set(timings[0][1][1:]))}
+
+
+def compare(result, baseline, tolerance):
+    """ Returns a list of the measurements that got worse than baseline by more than tolerance (0.1 is 10%). """
+    regressions = []
+
+    for key in ("pages_per_second", "ads_per_second"):  # Higher is better
+        if baseline.get(key) and key in result and result[key] < baseline[key] * (1 - tolerance):
+            regressions.append("{} fell from {} to {}".format(key, baseline[key], result[key]))
+
+    for key in ("seconds", "p99_ms", "parse_seconds", "peak_rss_mb", "requests", "import_ms", "startup_ms"):  # Lower is better
+        if baseline.get(key) and key in result and result[key] > baseline[key] * (1 + tolerance):
+            regressions.append("{} rose from {} to {}".format(key, baseline[key], result[key]))
+
+    for module in result.get("eager_imports", ()):
+        regressions.append("{} is imported at startup".format(module))
+
+    return regressions
+
+
+def main():
+    """ Call this to run the benchmarks """
+    parser = argparse.ArgumentParser(description="Benchmark craigraker against a local stand-in for craigslist")
+    parser.add_argument("-r", "--results", type=int, default=1200, help="The number of results the stand-in search reports")
+    parser.add_argument("-l", "--latency", type=float, default=20, help="Milliseconds the stand-in waits before each response")
+    parser.add_argument("-t", "--textsize", type=int, default=2000, help="Characters of text in each ad")
+    parser.add_argument("-v", "--verbose", help="Visit every ad and reply page, like craigraker --verbose", action="store_true")
+    parser.add_argument("-m", "--maxresults", type=int, default=2500, help="The maximum number of results to scrape")
+    parser.add_argument("--adconcurrency", type=int, default=20, help="The maximum number of ad pages fetched at once")
+    parser.add_argument("--parser", choices=["lxml", "soup"], help="The html parser to benchmark")
+    parser.add_argument("--startup", help="Measure how long importing craigraker takes instead of scraping", action="store_true")
+    parser.add_argument("-s", "--save", help="Save the measurements to this file as a baseline")
+    parser.add_argument("-c", "--compare", help="Compare against a saved baseline, exiting with status 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="How much worse than the baseline counts as a regression")
+    args = parser.parse_args()
+
+    if args.startup:
+        result = startup()
+
+    else:
+        result = run(total=args.results, latency=args.latency / 1000, text_size=args.textsize, verbose=args.verbose,
+                     max_results=args.maxresults, ad_concurrency=args.adconcurrency, parser=args.parser)
+
+    print(json.dumps(result, indent=2))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if args.compare and not exists(args.compare):
+        print("There is no baseline at {}".format(args.compare))
+
+    elif args.compare:
+        with open(args.compare) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+
+        for regression in regressions:
+            print("Regression: {}".format(regression))
+
+        if regressions:
+            sys.exit(1)
+
+    functions.get_loop().close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+#!/bin/python
+import sqlite3
+import time
+import zlib
+from os import makedirs
+from os.path import dirname, expanduser
+from urllib.parse import urlencode, urlsplit
+
+"""
+
+Craigraker! A really cool Craigslist scraper!
+
+The on-disk response cache used by fetch in craigraker_functions.py.
+Responses are stored compressed in a SQLite file keyed by url and query parameters.
+Search pages go stale quickly, ad and contact pages are kept much longer.
+Stale responses are revalidated with ETag/Last-Modified, and the least recently used
+responses are evicted once the cache grows past its size cap.
+
+Author: Ethan Henderson
+https://github.com/ethan626
+
+"""
+
+CACHE_CONFIG = {"enabled": True,
+                "path": "~/.cache/craigraker/responses.sqlite3",
+                "max_bytes": 200 * 1024 * 1024,
+                "ttl": {"search": 120,          # Seconds a search results page is fresh
+                        "ad": 24 * 60 * 60,     # Seconds an ad page is fresh
+                        "reply": 7 * 24 * 60 * 60}}  # Seconds a contact (reply) page is fresh
+
+_cache = None
+
+
+def cache_key(url, params=None):
+    """ Returns the key a response is stored under, the url plus its sorted query parameters. """
+    if not params:
+        return url
+
+    return url + "?" + urlencode(sorted((str(key), str(value)) for key, value in params.items()))
+
+
+def resource_type(url):
+    """ Returns "search", "reply" or "ad" depending on which kind of craigslist page url points to. """
+    path = urlsplit(url).path
+
+    if path.startswith("/search"):
+        return "search"
+
+    if path.startswith("/reply"):
+        return "reply"
+
+    return "ad"
+
+
+class ResponseCache:
+    """ A size capped, least recently used cache of response bodies stored in SQLite. """
+
+    def __init__(self, path, max_bytes, ttl):
+        self.path = expanduser(path)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        makedirs(dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path, isolation_level=None)  # Autocommit, every statement is its own transaction
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, body BLOB, etag TEXT,
+                           last_modified TEXT, stored REAL, accessed REAL, size INTEGER)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def lookup(self, url, params=None):
+        """ Returns (body, fresh, validator headers) for a cached response, or None if url is not cached. """
+        key = cache_key(url, params)
+        row = self.db.execute("SELECT body, etag, last_modified, stored FROM responses WHERE key = ?", (key,)).fetchone()
+
+        if row is None:
+            return None
+
+        body, etag, last_modified, stored = row
+        now = time.time()
+        self.db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+
+        validators = {}
+
+        if etag:
+            validators["If-None-Match"] = etag
+
+        if last_modified:
+            validators["If-Modified-Since"] = last_modified
+
+        fresh = now - stored < self.ttl[resource_type(url)]
+
+        return zlib.decompress(body).decode("utf-8"), fresh, validators
+
+    def store(self, url, params, text, headers):
+        """ Stores a response body along with its validators from the response headers. """
+        if "no-store" in headers.get("Cache-Control", ""):
+            return
+
+        key = cache_key(url, params)
+        body = zlib.compress(text.encode("utf-8"))
+        now = time.time()
+
+        old = self.db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (key, body, headers.get("ETag"), headers.get("Last-Modified"), now, now, len(body)))
+        self.size += len(body) - (old[0] if old else 0)
+
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def revalidated(self, url, params=None):
+        """ Marks a cached response as fresh again after the server answered 304 Not Modified. """
+        now = time.time()
+        self.db.execute("UPDATE responses SET stored = ?, accessed = ? WHERE key = ?", (now, now, cache_key(url, params)))
+
+    def evict(self):
+        """ Deletes the least recently used responses until the cache is back under 90% of its cap. """
+        target = self.max_bytes * 0.9
+        victims = []
+
+        for key, size in self.db.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            if self.size <= target:
+                break
+
+            victims.append((key,))
+            self.size -= size
+
+        self.db.executemany("DELETE FROM responses WHERE key = ?", victims)
+
+    def close(self):
+        self.db.close()
+
+
+def configure_cache(**config):
+    """ Change the cache options, for example configure_cache(enabled=False) or configure_cache(ttl={"search": 60}). """
+    ttl = config.pop("ttl", None)
+
+    if ttl:
+        CACHE_CONFIG["ttl"] = dict(CACHE_CONFIG["ttl"], **ttl)
+
+    CACHE_CONFIG.update(config)
+    close_cache()
+
+
+def get_cache():
+    """ Returns the shared response cache, opening it on first use. Returns None when caching is disabled. """
+    global _cache
+
+    if _cache is None and CACHE_CONFIG["enabled"]:
+        try:
+            _cache = ResponseCache(CACHE_CONFIG["path"], CACHE_CONFIG["max_bytes"], CACHE_CONFIG["ttl"])
+
+        except (OSError, sqlite3.Error):
+            print("Could not open the response cache at {}, continuing without it".format(CACHE_CONFIG["path"]))
+            CACHE_CONFIG["enabled"] = False
+
+    return _cache
+
+
+def close_cache():
+    """ Closes the shared response cache. """
+    global _cache
+
+    if _cache is not None:
+        _cache.close()
+
+    _cache = None
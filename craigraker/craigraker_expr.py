@@ -0,0 +1,236 @@
+#!/bin/python
+import ast
+import copy
+import re
+from datetime import datetime
+from functools import lru_cache
+from math import ceil, floor
+
+from craigraker_results import FIELDS, sortable
+
+"""
+
+Craigraker! A really cool Craigslist scraper!
+
+A small expression language for filtering and sorting ads, used by --filter and --sortby, the filter
+and sort keys of ~/.craigrakerrc, the filter key of batch job files, the GUI and craigraker serve. For example:
+
+    price < 500 and "trek" in lower(title) and hood != "tacoma"
+    matches(title, "road|gravel") and age(updated) < 2
+    price / 10 + age(posted)
+
+An expression is python syntax, but only comparisons, boolean logic, arithmetic, literals, the fields
+of an ad (title, price, hood, page_text, email, phone, url, updated, posted) and the functions in
+FUNCTIONS are allowed. There are no attributes, subscripts or imports, so an expression from a config
+file or a client of craigraker serve can not run anything else. Text and lists can't be repeated with *,
+so an expression can't build a huge string either, and expressions longer than MAX_LENGTH or nested
+deeper than MAX_DEPTH are refused before they can exhaust the parser. Expressions are checked and
+compiled once, then evaluated per ad.
+
+A row an expression can not be evaluated for, such as a price comparison on an ad with no price,
+does not pass a filter and sorts last.
+
+Author: Ethan Henderson
+https://github.com/ethan626
+
+"""
+
+SEARCH_FIELDS = ("title", "price", "hood", "url", "updated")  # Known from the search page, before the ad page is visited
+
+CONTACT_FIELDS = ("email", "phone")  # Only known once the reply page is visited, see CONTACTS in craigraker_functions.py
+
+MAX_LENGTH = 1000   # Characters, far more than any filter or sort needs
+
+MAX_DEPTH = 50      # Levels of the syntax tree, so checking and compiling never run out of stack
+
+NODES = (ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub, ast.UAdd, ast.BinOp, ast.Add, ast.Sub,
+         ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.In,
+         ast.NotIn, ast.Is, ast.IsNot, ast.IfExp, ast.Call, ast.Name, ast.Load, ast.Constant, ast.Tuple, ast.List)
+
+
+@lru_cache(maxsize=64)
+def pattern(regex):
+    return re.compile(regex, re.IGNORECASE)
+
+
+def age(date):
+    """ Days since date. """
+    return (datetime.now() - sortable(date)).total_seconds() / 86400
+
+
+def date(text):
+    """ A date, such as date("2019-01-31"), to compare updated and posted with. """
+    try:
+        return datetime.fromisoformat(text)
+
+    except ValueError:
+        raise ValueError("{!r} is not a date like 2019-01-31".format(text))
+
+
+def multiply(left, right):
+    """ a * b for numbers only. Repeating text or a list could use any amount of memory. """
+    if isinstance(left, SEQUENCES) or isinstance(right, SEQUENCES):
+        raise ValueError("Text and lists can not be repeated")
+
+    return left * right
+
+
+SEQUENCES = (str, bytes, list, tuple)
+
+FUNCTIONS = {"lower": str.lower, "upper": str.upper, "len": len, "abs": abs, "min": min, "max": max, "round": round,
+             "matches": lambda text, regex: pattern(regex).search(text) is not None,  # Case insensitive regex search
+             "age": age, "date": date}
+
+
+class Expression:
+    """ A compiled expression. Call it with an Ad for its value.
+
+        fields -- The fields of an ad the expression uses.
+        late -- True if it uses a field only known once the ad page has been visited, so it can't filter search results.
+        contacts -- True if it uses the email or phone, so the contacts of every ad must be looked up before it is used.
+    """
+
+    def __init__(self, text):
+        self.text = text
+
+        if len(text) > MAX_LENGTH:
+            raise ValueError("{!r}... is longer than {} characters".format(text[:40], MAX_LENGTH))
+
+        try:
+            tree = ast.parse(text.strip(), mode="eval")
+
+        except SyntaxError as e:
+            raise ValueError("{!r} is not a valid expression: {}".format(text, e.msg))
+
+        except (RecursionError, MemoryError):   # Nesting the parser itself can't handle
+            raise ValueError("{!r} is nested too deeply".format(text))
+
+        if depth(tree) > MAX_DEPTH:
+            raise ValueError("{!r} is nested more than {} levels deep".format(text, MAX_DEPTH))
+
+        for node in ast.walk(tree):
+            check(node, text)
+
+        self.tree = tree
+
+        try:
+            self.code = compile(ast.fix_missing_locations(Multiplications().visit(copy.deepcopy(tree))), "<expression>", "eval")
+
+        except (RecursionError, MemoryError):
+            raise ValueError("{!r} is nested too deeply".format(text))
+
+        self.fields = tuple(sorted({node.id for node in ast.walk(tree) if isinstance(node, ast.Name) and node.id in FIELDS}))
+        self.late = not set(self.fields) <= set(SEARCH_FIELDS)
+        self.contacts = bool(set(self.fields) & set(CONTACT_FIELDS))
+        self.scope = {"__builtins__": {}, "_multiply": multiply, **FUNCTIONS}  # Only reachable through Multiplications
+
+    def __call__(self, ad):
+        """ The value for ad, None if it could not be worked out. """
+        try:
+            return eval(self.code, self.scope, {field: sortable(getattr(ad, field)) for field in self.fields})
+
+        except Exception:       # A missing field, a bad date and the like
+            return None
+
+    def test(self, ad):
+        """ Whether ad passes the expression as a filter. """
+        return bool(self(ad))
+
+    def price_range(self):
+        """ The price bounds every passing ad must be within, as (min, max) with None for no bound. Only comparisons of price
+            with a number that the whole expression depends on (joined by and) count, so craigslist can filter on them too. """
+        low, high = None, None
+        terms = self.tree.body.values if is_and(self.tree.body) else [self.tree.body]
+
+        for term in terms:
+            if not isinstance(term, ast.Compare):
+                continue
+
+            operands = [term.left] + term.comparators
+
+            for left, op, right in zip(operands, term.ops, operands[1:]):
+                if is_number(left) and is_name(right, "price"):   # 50 < price is price > 50
+                    left, op, right = right, FLIPPED.get(type(op), op), left
+
+                if not (is_name(left, "price") and is_number(right)):
+                    continue
+
+                if isinstance(op, (ast.Gt, ast.GtE, ast.Eq)):
+                    low = max(low, floor(right.value)) if low is not None else floor(right.value)
+
+                if isinstance(op, (ast.Lt, ast.LtE, ast.Eq)):
+                    high = min(high, ceil(right.value)) if high is not None else ceil(right.value)
+
+        return low, high
+
+    def __repr__(self):
+        return "Expression({!r})".format(self.text)
+
+
+class Multiplications(ast.NodeTransformer):
+    """ Turns every a * b into _multiply(a, b), which checks its operands are numbers as the expression runs. """
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+
+        if not isinstance(node.op, ast.Mult):
+            return node
+
+        return ast.copy_location(ast.Call(func=ast.Name(id="_multiply", ctx=ast.Load()), args=[node.left, node.right],
+                                          keywords=[]), node)
+
+
+FLIPPED = {ast.Lt: ast.Gt(), ast.LtE: ast.GtE(), ast.Gt: ast.Lt(), ast.GtE: ast.LtE()}
+
+
+def check(node, text):
+    """ Raises ValueError for anything an expression is not allowed to contain. """
+    if not isinstance(node, NODES):
+        raise ValueError("{!r} can not contain {}".format(text, type(node).__name__))
+
+    if isinstance(node, ast.Name) and node.id not in FIELDS and node.id not in FUNCTIONS:
+        raise ValueError("{!r} uses {}, which is not a field ({}) or a function ({})".format(
+            text, node.id, ", ".join(FIELDS), ", ".join(sorted(FUNCTIONS))))
+
+    if isinstance(node, ast.Call) and (not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS or node.keywords):
+        raise ValueError("{!r} can only call the functions {}".format(text, ", ".join(sorted(FUNCTIONS))))
+
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Mult) and any(
+            isinstance(operand, (ast.List, ast.Tuple)) or isinstance(operand, ast.Constant) and isinstance(operand.value, SEQUENCES)
+            for operand in (node.left, node.right)):
+        raise ValueError("{!r} can not repeat text or lists with *".format(text))
+
+
+def depth(tree):
+    """ How many levels deep tree goes, worked out without recursion so any tree can be measured. """
+    deepest, stack = 0, [(tree, 1)]
+
+    while stack:
+        node, level = stack.pop()
+        deepest = max(deepest, level)
+        stack.extend((child, level + 1) for child in ast.iter_child_nodes(node))
+
+    return deepest
+
+
+def is_and(node):
+    return isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And)
+
+
+def is_name(node, name):
+    return isinstance(node, ast.Name) and node.id == name
+
+
+def is_number(node):
+    return isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool)
+
+
+def uses_contacts(field):
+    """ Whether sorting or filtering on field, a field name or an Expression, needs the email or phone of each ad. """
+    return field in CONTACT_FIELDS if isinstance(field, str) else field.contacts
+
+
+@lru_cache(maxsize=64)
+def compile_expression(text):
+    """ Returns the Expression for text, compiled once however often the same text is used. Raises ValueError for a bad one. """
+    return Expression(text)
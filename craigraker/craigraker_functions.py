@@ -1,14 +1,23 @@
 #!/bin/python
-import aiohttp
 import asyncio
-import lxml
-# import traceback
-from bs4 import BeautifulSoup as bs
-from dateutil.parser import parse
-from os import _exit
-from termcolor import colored
-
-from craigraker import LOOP 
+import configparser
+import contextvars
+import time
+import traceback
+from itertools import islice
+from urllib.parse import urlencode
+
+from craigraker_cache import get_cache, close_cache, configure_cache, resource_type
+from craigraker_expr import compile_expression, uses_contacts, SEARCH_FIELDS
+from craigraker_index import SeenIndex, Deduplicator
+from craigraker_results import Ad, AdBatch, Failure, FIELDS, HEADERS
+from craigraker_sort import Sorter
+from craigraker_store import AdStore, query_main
+from craigraker_output import open_writer, write_failures, print_result
+from craigraker_stats import get_stats, reset_stats, timed, start_metrics_server, profiled
+from craigraker_parsers import parse_async, configure_parser, close_parser_pool
+from craigraker_http import get_session, close_session, configure_session, get_scheduler, configure_scheduler, configure_network, \
+    job_slot, RETRY_CONFIG, configure_retries, transient, backoff_delay, hedged
 
 """
 
@@ -21,45 +30,186 @@ https://github.com/ethan626
 
 """
 
-async def fetch(url, params=None):
-    """ Fetches a url. Returns an awaitable. """
-    async with aiohttp.request('GET', url, params=params) as response:
-        return await response.text()
+# The list the current run's Failures are added to, None to only print them.
+# Tasks inherit it from the task that created them, so set it before starting a scrape.
+failure_log = contextvars.ContextVar("failure_log", default=None)
+
+# The Progress the current run reports to, see craigraker_progress.py. Inherited like failure_log.
+progress_tracker = contextvars.ContextVar("progress_tracker", default=None)
+
+# The Expression, from craigraker_expr.py, that the current run's ads must pass to be kept. Inherited like failure_log.
+row_filter = contextvars.ContextVar("row_filter", default=None)
+
+DEBUG = {"tracebacks": False}   # Print the traceback of every failure, see --debug
+
+# With eager False the reply pages of verbose ads are not visited along with the ad page. The ads keep the reply url
+# instead, and resolve_contacts looks up only the ones that are output, once sorting and --maxresults have picked them.
+CONTACTS = {"eager": True}
+
+_loop = None
+
+
+def report_progress(**counts):
+    """ Adds counts to the run's Progress, if it has one. """
+    tracker = progress_tracker.get()
+
+    if tracker is not None:
+        tracker.update(**counts)
+
+
+def keep(results, late=False):
+    """ Leaves out the results that do not pass the run's row_filter. A filter that only uses fields from the search page
+        is applied as the search page is parsed, before any ad pages are visited. One that needs the ad page is applied
+        once it has been visited (late). """
+    where = row_filter.get()
+
+    if where is None or where.late != late:
+        return results
+
+    kept = [result for result in results if where.test(result)]
+    get_stats().count("filtered", n=len(results) - len(kept))
+
+    return kept
+
+
+def record_failure(url, stage, error, message, params=None):
+    """ Prints message and adds a Failure for url, with params as its query string, to the failure log. """
+    print(message)
+    report_progress(errors=1)
+    get_stats().count("errors", stage)
+    get_stats().count("error_types", type(error).__name__)
+
+    if DEBUG["tracebacks"]:
+        traceback.print_exception(type(error), error, error.__traceback__)
+
+    failures = failure_log.get()
+
+    if failures is not None:
+        failures.append(Failure.from_exception(url + "?" + urlencode({key: value for key, value in params.items() if value is not None}) if params else url, stage, error))
+
+
+async def fetch(url, params=None, hedge=False, revalidate=False):
+    """ Fetches a url using the shared, pooled session once the scheduler allows it. Returns an awaitable.
+        Fresh responses are served from the on-disk cache, stale ones are revalidated with the server.
+        With revalidate, fresh ones are revalidated too, for pages known to have changed.
+
+        Transient failures are retried with jittered exponential backoff, see RETRY_CONFIG.
+        With hedge, a request still unanswered after RETRY_CONFIG["hedge"] seconds is sent a second time
+        and the first answer is used, so one slow connection does not hold up the whole search.
+        Raises aiohttp.ClientResponseError for error statuses, such as a 404 or craigslist still throttling us after every retry,
+        and asyncio.TimeoutError when the server does not answer in time. """
+    stats, kind = get_stats(), resource_type(url)
+    cache = get_cache()
+    cached = cache.lookup(url, params) if cache else None
+
+    if cached and cached[1] and not revalidate:     # Still fresh, no need to ask craigslist
+        stats.count("cache_hits", kind)
+        return cached[0]
 
+    def request():
+        return fetch_once(url, params, cached)
 
+    with stats.timer("fetch", kind):  # Everything, including waiting for a slot and retrying
+        for attempt in range(RETRY_CONFIG["retries"] + 1):
+            try:
+                if hedge and RETRY_CONFIG["hedge"]:
+                    return await hedged(request, RETRY_CONFIG["hedge"])
+
+                return await request()
+
+            except Exception as e:
+                if attempt == RETRY_CONFIG["retries"] or not transient(e):
+                    raise
+
+                stats.count("retries", kind)
+                await asyncio.sleep(backoff_delay(attempt, e))  # Outside the scheduler slot, so others can use it meanwhile
+
+
+async def fetch_once(url, params=None, cached=None):
+    """ Makes one request for fetch. cached is the stale cache entry to revalidate, if any. """
+    stats, kind = get_stats(), resource_type(url)
+    cache = get_cache()
+
+    async with get_scheduler().slot(url) as controller:
+        started = time.monotonic()
+
+        try:
+            async with get_session().get(url, params=params, headers=cached[2] if cached else None) as response:
+                body = await response.read()
+                text = await response.text()  # Decodes the body already read
+                latency = time.monotonic() - started
+                controller.record(latency, response.status)
+                stats.observe("request", latency, kind)  # Just the round trip, once we had a slot
+                stats.count("responses", kind)
+                stats.count("statuses", str(response.status))
+                stats.count("bytes", kind, len(body))
+                report_progress(bytes=len(body))
+
+                if response.status == 304 and cached:  # Not modified, the cached copy is still good
+                    stats.count("cache_revalidated", kind)
+                    cache.revalidated(url, params)
+                    return cached[0]
+
+                response.raise_for_status()
+
+                if cache:
+                    cache.store(url, params, text, response.headers)
+
+                return text
+
+        except asyncio.TimeoutError:  # A host that stops answering is struggling, so back off from it
+            stats.count("timeouts", kind)
+            controller.cut()
+            raise
+
+
+async def gather_bounded(coroutines, limit):
+    """ Runs the coroutines concurrently with at most limit of them in flight.
+        Returns their results in the original order, exceptions are returned in place of a result. """
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def bounded(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*[bounded(coroutine) for coroutine in coroutines], return_exceptions=True)
+
+
+@timed("contact")
 async def get_contact_info(url, params=None):
     """ Gets the email address and phone number in the ad. Return a tuple. """
-    email_address, phone_number = "N/A","N/A"
+    email_address, phone_number = None, None
 
     try:
         response = await fetch(url, params=params)
-        soup = bs(response, "lxml")
+        email_address, phone_number = await parse_async("contact", response)
 
-        for email in soup("p", class_="anonemail"):
-            email_address = email.text
-            email_address = email_address.replace(",", "")
+    except Exception as e:
+        record_failure(url, "contact", e, "Could not aquire contact info from {}".format(url))
 
-        for phone in soup("p", class_="reply-tel-number"):
-            phone_number = phone.text
-            phone_number = phone_numbe.replace(",", "")
+    return email_address, phone_number
 
-    except Exception:
-        print("Could not aquire contact info from {}".format(url))
-        # print(traceback.format_exc())
 
-    return email_address, phone_number
+async def get_first_page(url, query, wanted=False, max_results=120, sort=None, filters=None):
+    """ Fetches and parses the first page of a search. Returns the total number of results and the ads on the page,
+        (None, []) if the search fails. The one response gives both, so the first page is never fetched twice. """
+    params = search_parameters(query, 1, filters)[0]
 
+    if sort:
+        params["sort"] = sort
 
-async def get_total_results(url, params=None):
-    """ Returns the total number of search results"""
     try:
-        response = await fetch(url, params=params)
-        soup = bs(response, 'lxml')
-        return int(soup('span', class_='totalcount')[0].text)
+        response = await fetch(url, params=params, hedge=True)
+        total_results, results = await parse_async("first", response, wanted=wanted, max_results=max_results)
 
-    except Exception:
-        print("Could not get the total number of search results from Craigslist")
-        # print(traceback.format_exc())
+    except Exception as e:
+        record_failure(url, "search", e, "Could not scrape {}".format(url), params=params)
+        return None, []
+
+    if total_results is None:   # No count on the page, so this is the only page
+        total_results = len(results)
+
+    return total_results, results
 
 
 def parse_section(user_choice):
@@ -93,209 +243,496 @@ def parse_section(user_choice):
         return ""
 
 
-def print_result(result, color=False):
-    """ Print the scraped data colored with ANSI colors """
-    if len(result) == 9:
-        if color:
-            return("{0},{1},{2},{3},{4},{5},{6},{7},{8}".format(colored(result[0], "white"),
-                                                               colored(result[1], "red"),
-                                                               colored(result[2], "yellow"),
-                                                               colored(result[3], "green"),
-                                                               colored(result[4], "blue"),
-                                                               colored(result[5], "cyan"),
-                                                               colored(result[6], "magenta"),
-                                                               colored(result[7], "white"),
-                                                               colored(result[8], "red")))
-        else:
-            return("{0},{1},{2},{3},{4},{5},{6},{7},{8}".format(*result))
-
-    elif len(result) == 6:
-        if color:
-            return("{0},{1},{2},{3},{4},{5}".format(colored(result[0], "white"),
-                                                   colored(result[1], "red"),
-                                                   colored(result[2], "yellow"),
-                                                   colored(result[3], "green"),
-                                                   colored(result[4], "blue"),
-                                                   colored(result[5], "cyan")))
-        else:
-            return("{0},{1},{2},{3},{4},{5}".format(*result))
-
-    elif len(result) == 5:
-        if color:
-            return("{0},{1},{2},{3},{4}".format(colored(result[0], "white"),
-                                               colored(result[1], "red"),
-                                               colored(result[2], "yellow"),
-                                               colored(result[3], "green"),
-                                               colored(result[4], "cyan")))
-        else:
-            return("{0},{1},{2},{3},{4}".format(*result))
-
-    elif len(result) == 4:
-        if color:
-            return("{0},{1},{2},{3}".format(colored(result[0], "white"),
-                                           colored(result[1], "red"),
-                                           colored(result[2], "yellow"),
-                                           colored(result[3], "green")))
-        else:
-            return("{0},{1},{2},{3}".format(*result))
-
-
-def scrape(url, local_cl_url, query, max_results=120, verbose=False, wanted=False):
-    """ Executes a scrape of craigslist. Returns a list of the results. """
-    try:  # Get the max number of results for this query
-        tasks = [asyncio.ensure_future(get_total_results(url,
-                                                        params={"query": query,
-                                                        "User-Agent": """Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1)
-                                                        AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36"""}))]
-
-        completed, _ = LOOP.run_until_complete(asyncio.wait(tasks))
-        total_results = [i.result() if not max_results or i.result() < max_results
-                         else max_results for i in completed if i.result()][0]  # Getting the max number of results
-
-        parameters = [{"s": result_count, "query":
-                       query, "User-Agent": """Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1)
-                              AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/538.36"""}
-                      for result_count in range(0, total_results, 120)]  # Each page is 120 results or less
-
-        tasks = [asyncio.ensure_future(scrape_search_page(url,
-                                                          local_cl_url,
-                                                          params=param,
-                                                          max_results=total_results,
-                                                          verbose=verbose,
-                                                          wanted=wanted))
-                                                          for param in parameters]
-
-        completed, _ = LOOP.run_until_complete(asyncio.wait(tasks))
-        results = []
-        _ = [results.extend(key.result()) for key in completed if key.result()]
+def search_urls(city, sublocation="", section="sss?"):
+    """ Returns the search url and the local craigslist url for a city, sublocation and section. """
+    local_cl_url = "https://" + city + ".craigslist.org" + sublocation
 
-        return results
+    if sublocation:
+        search_url = "https://" + city + ".craigslist.org/search/" + sublocation + "/" + section
+
+    else:
+        search_url = "https://" + city + ".craigslist.org/search/" + section
+
+    return search_url, local_cl_url
+
+
+def load_jobs(path, max_results=2500, verbose=False, wanted=False, filters=None, where=None):
+    """ Reads a batch job file. Returns a list of jobs, one per section of the file.
+
+        The file uses the same format as ~/.craigrakerrc, options in [DEFAULT] apply to every job:
+
+            [DEFAULT]
+            city = seattle
+            maxresults = 240
+
+            [bikes]
+            query = bike
+
+            [portland couches]
+            city = portland
+            query = couch
+            section = fuo
+
+        Each job may set city, sublocation, section, query, maxresults, firstpage, verbose and ignorewanted,
+        the craigslist filters minprice, maxprice, postedtoday, hasimage and titleonly, and a filter expression.
+        Anything not set falls back to the keyword arguments, filters being keyword arguments of search_filters
+        and where the text of an expression.
+        Raises ValueError for a bad filter expression, or one that needs the ad page of a job that is not verbose.
+    """
+    config = configparser.ConfigParser()
+
+    if not config.read(path):
+        raise ValueError("Could not read the batch job file {}".format(path))
+
+    jobs = []
+
+    for name in config.sections():
+        job = config[name]
+        job_where = job.get("filter", where) or None
+        expression = compile_expression(job_where) if job_where else None
+        job_verbose = job.getboolean("verbose", verbose)
+
+        if expression is not None and expression.late and not job_verbose:
+            raise ValueError("The filter of {} uses fields of the ad page, which needs verbose".format(name))
+
+        job_filters = config_filters(job, where=expression, **(filters or {}))
+        jobs.append(new_job(name, job.get("city", "seattle"), job.get("sublocation", ""), job.get("section", "sss?"),
+                            job.get("query"), max_results=job.getint("maxresults", max_results),
+                            firstpage=job.getboolean("firstpage", False), verbose=job_verbose,
+                            wanted=job.getboolean("ignorewanted", wanted), filters=job_filters,
+                            where=job_where))
+
+    return jobs
+
+
+def new_job(name, city="seattle", sublocation="", section="sss?", query=None, max_results=2500, firstpage=False,
+            verbose=False, wanted=False, filters=None, where=None):
+    """ Returns a job, the search iter_batch and craigraker_serve.py run, with its urls worked out.
+        filters are from search_filters, where is the text of an expression its ads must pass. """
+    search_url, local_cl_url = search_urls(city, sublocation, section)
+    max_results = 120 if firstpage else min(max_results, 2500)
+
+    return {"name": name, "search_url": search_url, "local_cl_url": local_cl_url, "query": query,
+            "max_results": max_results, "verbose": verbose, "wanted": wanted, "filters": filters or {}, "where": where}
+
+
+def configure_from(config):
+    """ Applies the request limits, timeouts, retries, cache and parser settings of a ~/.craigrakerrc ConfigParser,
+        for the subcommands that have no flags of their own for them. Raises ValueError for an unknown parser. """
+    configure_network(max_requests=config["DEFAULT"].getint("maxrequests", 50),  # Request limits
+                      max_per_host=config["DEFAULT"].getint("maxperhost", 10),
+                      rate=config["DEFAULT"].getfloat("rate", 0),
+                      adaptive=config["DEFAULT"].getboolean("adaptive", True))
+
+    configure_session(connect_timeout=config["DEFAULT"].getfloat("connecttimeout", 10),  # Timeouts and retries
+                      read_timeout=config["DEFAULT"].getfloat("readtimeout", 30))
+
+    configure_retries(retries=config["DEFAULT"].getint("retries", 3),
+                      hedge=config["DEFAULT"].getfloat("hedge", 0))
+
+    configure_cache(enabled=config["DEFAULT"].getboolean("cache", True),
+                    max_bytes=config["DEFAULT"].getint("cachesize", 200) * 1024 * 1024)  # Cache size is in megabytes
+
+    configure_parser(backend=config["DEFAULT"].get("parser", "lxml"),
+                     workers=config["DEFAULT"].getint("parseworkers", 0))
+
+
+def search_parameters(query, total_results, filters=None):
+    """ Returns the request parameters for each page of a search with total_results results, filtered by search_filters. """
+    return [dict(filters or {}, s=result_count, query=query)  # The User-Agent is sent as a header by the shared session
+            for result_count in range(0, total_results, 120)]  # Each page is 120 results or less
+
+
+def search_filters(min_price=None, max_price=None, posted_today=False, has_image=False, title_only=False, where=None):
+    """ Returns the search parameters that have craigslist filter a search itself, so there are fewer pages to fetch.
+        The price bounds of a where Expression are added too, it is still tested against every ad as well. """
+    if where is not None:
+        low, high = where.price_range()
+        min_price = low if min_price is None else min_price if low is None else max(min_price, low)
+        max_price = high if max_price is None else max_price if high is None else min(max_price, high)
+
+    filters = {}
+
+    if min_price is not None:
+        filters["min_price"] = int(min_price)
+
+    if max_price is not None:
+        filters["max_price"] = int(max_price)
+
+    if posted_today:
+        filters["postedToday"] = 1
+
+    if has_image:
+        filters["hasPic"] = 1
+
+    if title_only:              # Only match the query against titles
+        filters["srchType"] = "T"
+
+    return filters
+
+
+def config_filters(section, min_price=None, max_price=None, posted_today=False, has_image=False, title_only=False, where=None):
+    """ Returns search_filters for the minprice, maxprice, postedtoday, hasimage and titleonly options of a config section,
+        falling back to the keyword arguments. """
+    return search_filters(min_price=section.getint("minprice", min_price), max_price=section.getint("maxprice", max_price),
+                          posted_today=section.getboolean("postedtoday", posted_today),
+                          has_image=section.getboolean("hasimage", has_image),
+                          title_only=section.getboolean("titleonly", title_only), where=where)
 
-    except IndexError as e:
-        # print(traceback.format_exc())
+
+async def iter_scrape(url, local_cl_url, query, max_results=120, verbose=False, wanted=False, ad_concurrency=20, index=None,
+                      dedupe=None, filters=None):
+    """ Executes a scrape of craigslist, yielding each result as soon as it is ready.
+        Nothing is yielded if there are no results or the search fails.
+
+        The first page gives the total number of results as well as its ads. The rest of the pages, only as many as
+        max_results needs, are then requested at once while the first page's ads are visited, and their results are
+        interleaved in the order they finish.
+
+        If a SeenIndex is given only new or updated ads are yielded, and they are remembered in the index once their ad
+        pages have been visited, see iter_ads. Pages are then requested newest first, one at a time, and paging stops at
+        the first page with an ad already seen.
+
+        Ads found more than once (the same posting id, or the same title, price and neighborhood) are only kept
+        the first time, before their ad pages are fetched. dedupe is the Deduplicator to share, None for a new one,
+        or False to keep duplicates. filters are search_filters for craigslist to apply.
+    """
+    dedupe = Deduplicator() if dedupe is None else dedupe or None
+    total_results, first = await get_first_page(url, query, wanted=wanted, max_results=max_results or 120,
+                                                sort="date" if index is not None else None, filters=filters)
+
+    if not total_results:
         print("Sorry, no results.")
-        _exit(status=0)         # No results so exit the script
+        return
 
-    except Exception:
-        print("Could not scrape {}".format(url))
-        # print(traceback.format_exc())
-        _exit(status=1)
+    if max_results:
+        total_results = min(total_results, max_results)
 
+    skipped = index.skipped if index is not None else 0
+    first = filter_results(first, index=index, dedupe=dedupe)
+    parameters = search_parameters(query, total_results, filters)[1:]  # The first page is already here
+    report_progress(pages=len(parameters) + 1, expected=total_results)
+    page_done(first, verbose)
 
-async def scrape_ad_page(url, local_cl_url, contact_info=False, params=None):
-    """ Scrapes a Craigslist ad page. Returns a tuple of the page text, date, contact email, and contact phone number. """
-    try:
-        response = await fetch(url, params=params)
-        soup = bs(response, "lxml")
+    if index is not None:       # Newest first, one page at a time, stopping at the first page with an ad already seen
+        async for result in iter_ads(first, local_cl_url, verbose=verbose, ad_concurrency=ad_concurrency, index=index):
+            yield result
 
-        page_text = soup("section", {"id": "postingbody"})[0].text
-        page_text = page_text.replace("\n\nQR Code Link to This Post\n\n\n", "")  # Remove the junk
-        page_text = page_text.replace(",", "")
-        page_text = page_text.replace("\n", "")
-        page_text = page_text.strip()
+        for param in parameters:
+            if index.skipped > skipped:
+                break
 
-    except IndexError:
-        page_text = ""
+            skipped = index.skipped
+            param["sort"] = "date"
 
-    except Exception:
-        print("Could not scrape {}".format(url))
-        # print(traceback.format_exc())
+            async for result in iter_search_page(url, local_cl_url, params=param, max_results=total_results - param["s"],
+                                                 verbose=verbose, wanted=wanted, ad_concurrency=ad_concurrency,
+                                                 index=index, dedupe=dedupe):
+                yield result
 
-    try:
-        date = parse(soup("time", class_="date timeago")[0].text)
+        return
 
-    except IndexError:
-        date = ""
+    # The other pages are requested straight away, alongside the ad pages of the first
+    pages = [iter_search_page(url, local_cl_url, params=param, max_results=total_results - param["s"], verbose=verbose,
+                              wanted=wanted, ad_concurrency=ad_concurrency, dedupe=dedupe)
+             for param in parameters]
 
-    for contact_link in soup("a", {"id": "replylink"}):
-        contact_link = local_cl_url + contact_link["href"]
+    def failed(i, error):
+        record_failure(url, "search", error, "Could not scrape {}".format(url))
 
-    if contact_info:
-        contact_email, contact_phone = "N/A", "N/A"
+    async for result in merge([iter_ads(first, local_cl_url, verbose=verbose, ad_concurrency=ad_concurrency)] + pages, failed):
+        yield result
+
+
+async def merge(iterators, failed, setup=None):
+    """ Runs several async iterators concurrently, yielding their items in the order they become ready.
+        failed is called with the index of an iterator that fails and its exception, the others carry on.
+        setup is called at the start of each iterator's task. """
+    queue = asyncio.Queue()
+    done = object()
 
+    async def drain(i, iterator):
         try:
-            contact_email, contact_phone = await get_contact_info(contact_link)
+            if setup is not None:
+                setup()
+
+            async for item in iterator:
+                await queue.put(item)
+
+        except Exception as e:
+            failed(i, e)
+
+        finally:
+            await queue.put(done)  # This iterator is finished
+
+    tasks = [asyncio.ensure_future(drain(i, iterator)) for i, iterator in enumerate(iterators)]
+    remaining = len(tasks)
+
+    try:
+        while remaining:
+            item = await queue.get()
+
+            if item is done:
+                remaining -= 1
+
+            else:
+                yield item
+
+    finally:                    # Stopped early or cancelled, so stop the iterators too
+        for task in tasks:
+            task.cancel()
+
+
+async def iter_batch(jobs, ad_concurrency=20, job_concurrency=None, dedupe=None):
+    """ Scrapes every job from load_jobs at once on this event loop, sharing the session and scheduler.
+        Yields (job name, result) as soon as each result is ready.
+
+        Each job may only have job_concurrency requests in flight, so that a big job cannot starve the others.
+        By default the scheduler's request limit is split evenly between the jobs.
+        An ad cross-posted to several of the searches is only yielded for the first to find it, unless dedupe is False.
+    """
+    dedupe = Deduplicator() if dedupe is None else dedupe
+
+    if job_concurrency is None:
+        job_concurrency = max(2, get_scheduler().max_requests // max(1, len(jobs)))
+
+    async def tagged(job):
+        row_filter.set(compile_expression(job["where"]) if job["where"] else None)  # Each job runs in its own task
+
+        async for result in iter_scrape(job["search_url"], job["local_cl_url"], job["query"],
+                                        max_results=job["max_results"], verbose=job["verbose"], wanted=job["wanted"],
+                                        ad_concurrency=ad_concurrency, dedupe=dedupe, filters=job["filters"]):
+            yield job["name"], result
+
+    def failed(i, error):       # The other jobs carry on
+        record_failure(jobs[i]["search_url"], "search", error, "Could not scrape the batch job {}".format(jobs[i]["name"]))
+
+    def own_slots():            # Runs in each job's task, and the tasks it starts inherit the limit
+        job_slot.set(asyncio.Semaphore(job_concurrency))
+
+    async for item in merge([tagged(job) for job in jobs], failed, setup=own_slots):
+        yield item
+
+
+def get_loop():
+    """ Returns the event loop craigraker runs on. It is made on first use, not when craigraker is imported,
+        and a new one is made if the last was closed. """
+    global _loop
+
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+
+    return _loop
+
+
+def close_all():
+    """ Closes the session, response cache and parsing pool. Call before closing the event loop.
+        Tasks still running, such as those of a cancelled scrape, are cancelled and left to finish first.
+        The scheduler's locks belong to this loop, so it is dropped too and made again on the next loop. """
+    loop = get_loop()
+    tasks = asyncio.all_tasks(loop)
+
+    for task in tasks:
+        task.cancel()
+
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    loop.run_until_complete(close_session())  # Close the pooled connections before the loop goes away
+    configure_scheduler()
+    close_cache()
+    close_parser_pool(wait=True)
+
+
+async def consume(results, callback):
+    """ Calls callback with each result from an async iterator of results, such as iter_scrape. """
+    async for result in results:
+        callback(result)
+
+
+def scrape(url, local_cl_url, query, max_results=120, verbose=False, wanted=False, ad_concurrency=20, index=None, dedupe=None,
+           filters=None):
+    """ Executes a scrape of craigslist with iter_scrape on craigraker's event loop. Returns the results as an AdBatch,
+        in the order they were scraped. """
+    results = AdBatch()
+    get_loop().run_until_complete(consume(iter_scrape(url, local_cl_url, query, max_results=max_results, verbose=verbose,
+                                                      wanted=wanted, ad_concurrency=ad_concurrency, index=index, dedupe=dedupe,
+                                                      filters=filters),
+                                          results.append))
+
+    return results
+
 
-        except Exception:              # Ignore pages we can't get info from.
+@timed("ad_page")
+async def scrape_ad_page(url, local_cl_url, contact_info=False, params=None, lazy_contact=False, revalidate=False):
+    """ Scrapes a Craigslist ad page. Returns a tuple of the page text, date, contact email, and contact phone number.
+        With lazy_contact the reply page is not visited, the email and phone are None and its url is added to the tuple.
+        With revalidate a cached copy of the ad page is checked with craigslist however fresh it is, see fetch. """
+    response = await fetch(url, params=params, revalidate=revalidate)
+    page_text, date, contact_link = await parse_async("ad", response)
+
+    if contact_info:
+        contact_email, contact_phone = None, None
+
+        if contact_link is None:              # Ignore pages we can't get info from.
             print("Could not gather contact information from {}".format(url))
-            # print(traceback.format_exc())
+
+        elif lazy_contact:
+            return page_text, date, None, None, local_cl_url + contact_link
+
+        else:
+            contact_email, contact_phone = await get_contact_info(local_cl_url + contact_link)
 
         return page_text, date, contact_email, contact_phone
 
     return page_text, date
 
 
-async def scrape_search_page(url, local_cl_url, params=None, verbose=False, wanted=False, max_results=120):
+async def resolve_contacts(ads, concurrency=20):
+    """ Looks up the email and phone of the ads visited without them, see CONTACTS, all at once. Returns the ads. """
+    waiting = [ad for ad in ads if ad.contact is not None]
+    contacts = await gather_bounded([get_contact_info(ad.contact) for ad in waiting], concurrency)
+
+    for ad, contact in zip(waiting, contacts):
+        if not isinstance(contact, Exception):  # get_contact_info records its own failures
+            ad.email, ad.phone = contact
+
+        ad.contact = None
+
+    return ads
+
+
+def with_contacts(items, ad=None, concurrency=20, chunk=100):
+    """ Yields items, such as a Sorter's sorted ads, once the contacts of each chunk of them have been resolved.
+        ad returns the ad from an item, when the items hold an ad rather than being one. """
+    ad = ad or (lambda item: item)
+    items = iter(items)
+
+    while True:
+        batch = list(islice(items, chunk))
+
+        if not batch:
+            return
+
+        get_loop().run_until_complete(resolve_contacts([ad(item) for item in batch], concurrency))
+        yield from batch
+
+
+async def parse_search_page(response, wanted=False, max_results=120, index=None, dedupe=None):
+    """ Parses the html of a craigslist search page. Returns a list of results, one per ad, see iter_search_page. """
+    results = await parse_async("search", response, wanted=wanted, max_results=max_results)
+
+    return filter_results(results, index=index, dedupe=dedupe)
+
+
+def filter_results(results, index=None, dedupe=None):
+    """ Leaves out the results a SeenIndex or Deduplicator has seen, and those the row_filter turns down,
+        before anything fetches their ad pages. """
+    if index is not None:       # Leave out ads seen before and not updated since
+        results = [result for result in results if index.changed(result.url, result.updated)]
+
+    if dedupe is not None:      # Leave out ads another page of this run already has
+        duplicates = dedupe.duplicates
+        results = dedupe.unique(results)
+        get_stats().count("duplicates", n=dedupe.duplicates - duplicates)
+
+    return keep(results)
+
+
+def page_done(results, verbose=False):
+    """ Reports a search page and the results kept from it. Without verbose the results are finished already. """
+    report_progress(pages_done=1, ads=len(results), ads_done=0 if verbose else len(results))
+
+
+def add_ad_page(result, ad_page):
+    """ Fills in a search result with what scrape_ad_page found on the ad's own page. Returns False if it failed. """
+    report_progress(ads_done=1)
+
+    if isinstance(ad_page, Exception):
+        record_failure(result.url, "ad", ad_page, "Could not extract the data (verbose) for {}".format(result.url))
+        return False
+
+    result.page_text, result.posted, result.email, result.phone = ad_page[:4]
+    result.contact = ad_page[4] if len(ad_page) > 4 else None
+    return True
+
+
+async def iter_search_page(url, local_cl_url, params=None, verbose=False, wanted=False, max_results=120, ad_concurrency=20,
+                           index=None, dedupe=None):
     """ Scrape the page of a craigslist search.
 
-        Returns [ad_title, price, neighborhood,link] or
+        Yields an Ad for every ad on the page, with its title, price, neighborhood, url and updated date, and
 
         if verbose:
-            [ad_title, price, neighborhood, ad text, link]
+            the ad text, date posted, email and phone number from the ad's own page. Results are then yielded in the
+            order their ad pages finish rather than the order of the ads.
 
         Kwargs:
             params -- params for the http request.
             verbose -- Verbose output, the function will visit every ad and extract the text from within the ad.
             wanted -- Ignore ads with wanted in the title if set to True.
             max_results -- The maximum number of results to keep.
+            ad_concurrency -- The maximum number of ad pages (and their contact pages) fetched at once when verbose.
+            index -- A SeenIndex, ads it has already seen with the same updated date are left out, the rest are marked seen.
+            dedupe -- A Deduplicator shared by the pages of a run, ads it has already seen are left out.
     """
     try:
-        response = await fetch(url, params=params)
-        soup = bs(response, 'lxml')
-
-    except Exception:
-        print("Could not scrape {}".format(url))
-        # print(traceback.format_exc())
-
-    results = []
-
-    for ad, counter in zip(soup("p", {"class": "result-info"}), range(max_results)):
-        if wanted:              # Ignore wanted ads
-            if 'wanted' in ad.text.lower():
-                continue
-
-        for price in ad("span", {"class": "result-price"}):
-            price = price.text
-            price = price.strip()
-            price = price.replace("(", "")
-            price = price.replace(")", "")
-            price = price.replace("$", "")
-            price = price.replace(",", "")
-            price = price.replace("\n", "")
-            price = float(price)
-
-        for hood in ad("span", {"class": "result-hood"}):
-            hood = hood.text
-            hood = hood.strip()
-            hood = hood.replace(",", "")
-            hood = hood.replace("(", "")
-            hood = hood.replace(")", "")
-            hood = hood.replace("\n", "")
-
-        for link_text in ad("a", {"class": "result-title hdrlnk"}):
-            ad_title = link_text.text
-            ad_title = ad_title.strip()
-            ad_title = ad_title.replace("\n", "")
-            ad_title = ad_title.replace(",", "")
-            ad_url = link_text["href"]
-
-        for date in ad("time", {"class", "result-date"}):
-            date_updated = parse(date["datetime"])
+        response = await fetch(url, params=params, hedge=True)
 
-        if verbose:
+    except Exception as e:
+        record_failure(url, "search", e, "Could not scrape {}".format(url), params=params)
+        report_progress(pages_done=1)
+        return
+
+    results = await parse_search_page(response, wanted=wanted, max_results=max_results, index=index, dedupe=dedupe)
+    page_done(results, verbose)
+
+    async for result in iter_ads(results, local_cl_url, verbose=verbose, ad_concurrency=ad_concurrency, index=index):
+        yield result
+
+
+async def iter_ads(results, local_cl_url, verbose=False, ad_concurrency=20, index=None):
+    """ Visits every ad in a list of search results concurrently, filling each in from its own page, and yields each as soon
+        as its ad page has been visited. Without verbose, the results are yielded as they are. Results the row_filter turns
+        down once their ad pages are in are left out.
+
+        With a SeenIndex, the results are new or updated ads, so their ad pages are revalidated rather than served from the
+        cache. Each is marked seen once its ad page is in, whether or not the row_filter keeps it. One whose ad page could
+        not be visited is left unmarked, to be tried again next time. """
+    if not verbose:
+        if index is not None:
+            index.mark(results)
+
+        for result in keep(results, late=True):
+            yield result
+
+        return
+
+    semaphore = asyncio.Semaphore(max(1, ad_concurrency))
+
+    async def visit(result):
+        async with semaphore:
             try:
-                page_text, date_posted, contact_email, contact_phone = await scrape_ad_page(ad_url, local_cl_url, contact_info=True)
+                visited = add_ad_page(result, await scrape_ad_page(result.url, local_cl_url, contact_info=True,
+                                                                   lazy_contact=not CONTACTS["eager"],
+                                                                   revalidate=index is not None))
 
-            except Exception:
-                print("Could not extract the data (verbose) for {}".format(ad_url))
-                # print(traceback.format_exc())
+            except Exception as e:
+                visited = add_ad_page(result, e)
 
-        local_vars = locals()   # This is used in the list comprehension below to check if certain variables exist.
-        result = [local_vars[ad_data] if ad_data in local_vars else "None"
-                  for ad_data in ["ad_title", "price", "hood", "page_text",
-                                  "contact_email", "contact_phone", "ad_url",
-                                  "date_updated", "date_posted"]]
-        if result != []:
-            results.append(result)
+        return result, visited
 
-    return results
+    visits = [asyncio.ensure_future(visit(result)) for result in results]
+
+    try:
+        for finished in asyncio.as_completed(visits):
+            result, visited = await finished
+
+            if visited and index is not None:
+                index.mark([result])
+
+            for result in keep([result], late=True):
+                yield result
+
+    finally:                    # Stopped early or cancelled, so stop visiting
+        for task in visits:
+            task.cancel()
@@ -4,6 +4,7 @@ import configparser
 from gooey import Gooey, GooeyParser
 from os.path import expanduser, exists
 from craigraker_functions import *
+from craigraker_progress import Progress, cancel_on_signals
 
 """
 
@@ -20,17 +21,23 @@ https://github.com/ethan626
 
 """
 
-LOOP = asyncio.get_event_loop()
-
-
-@Gooey
+@Gooey(progress_regex=r"^Progress: (?P<done>\d+)/(?P<total>\d+)", progress_expr="done * 100 / total", hide_progress_msg=True,
+       timing_options={"show_time_remaining": True, "hide_time_remaining_on_complete": True})
 def main():
     """ Call this to start scraping """
     parser = GooeyParser(description="Craigraker")
     parser.add_argument("-Query", help="The search term")
-    parser.add_argument("-File", help="The file to which Craigraker will write/append the output.")
+    parser.add_argument("-File", help="The file to which Craigraker will write/append the output. \
+                                       Files ending in .ndjson or .parquet are written in that format, anything else as csv.")
     parser.add_argument("-Sort", choices=["Do Not Sort", "Price Descending", "Price Ascending", "Location", "Date Descending", "Date Ascending"],
                                             help="Click the dropdown menu to select a sorting method or not to sort.")
+    parser.add_argument("-SortBy", help="Or sort by an expression of the ad's fields, smallest first. Example: price / 10 + age(posted)")
+    parser.add_argument("-Filter", help="Only keep ads for which this expression is true. Example: price < 500 and 'trek' in lower(title)")
+    parser.add_argument("-MinPrice", type=int, help="Have Craigslist only return ads priced at least this")
+    parser.add_argument("-MaxPrice", type=int, help="Have Craigslist only return ads priced at most this")
+    parser.add_argument("-PostedToday", help="Have Craigslist only return ads posted today", action="store_true")
+    parser.add_argument("-HasImage", help="Have Craigslist only return ads with pictures", action="store_true")
+    parser.add_argument("-TitleOnly", help="Have Craigslist only match the search term against ad titles", action="store_true")
     parser.add_argument("-Results", type=int, help="The maximum number of results to display")
     parser.add_argument("-Location", help="Which Craigslist location to use. Example: Seattle")
     parser.add_argument("-Sublocation", help="""Which sublocation to use.
@@ -46,7 +53,11 @@ def main():
     config = configparser.ConfigParser()
 
     if not exists(expanduser("~/.craigrakerrc")):  # if path does not exist, create the config file in the home directory
-        config["DEFAULT"] = {"city": "seattle", "sublocation": "", "section": "", "maxresults": 2500, "firstpage": False, "sort": False}
+        config["DEFAULT"] = {"city": "seattle", "sublocation": "", "section": "", "maxresults": 2500, "firstpage": False, "sort": False,
+                             "maxrequests": 50, "maxperhost": 10, "rate": 0, "adaptive": True,
+                             "connecttimeout": 10, "readtimeout": 30, "retries": 3, "hedge": 0, "dedupe": True,
+                             "sortmemory": 256, "store": False,
+                             "cache": True, "cachesize": 200, "parser": "lxml", "parseworkers": 0}
 
         with open(expanduser("~/.craigrakerrc"), "w+") as configfile:
             config.write(configfile)
@@ -72,13 +83,28 @@ def main():
     if not args.Section:        # Default to for sale
         section = "sss?"
 
-    local_cl_url = "https://" + city + ".craigslist.org" + sublocation
+    search_url, local_cl_url = search_urls(city, sublocation, section)
+
+    configure_network(max_requests=config["DEFAULT"].getint("maxrequests", 50),  # Request limits
+                      max_per_host=config["DEFAULT"].getint("maxperhost", 10),
+                      rate=config["DEFAULT"].getfloat("rate", 0),
+                      adaptive=config["DEFAULT"].getboolean("adaptive", True))
+
+    configure_session(connect_timeout=config["DEFAULT"].getfloat("connecttimeout", 10),  # Timeouts and retries
+                      read_timeout=config["DEFAULT"].getfloat("readtimeout", 30))
 
-    if sublocation:
-        search_url = "https://" + city + ".craigslist.org/search/" + sublocation + "/" + section
+    configure_retries(retries=config["DEFAULT"].getint("retries", 3),
+                      hedge=config["DEFAULT"].getfloat("hedge", 0))
 
-    else:
-        search_url = "https://" + city + ".craigslist.org/search/" + section
+    configure_cache(enabled=config["DEFAULT"].getboolean("cache", True),
+                    max_bytes=config["DEFAULT"].getint("cachesize", 200) * 1024 * 1024)  # Cache size is in megabytes
+
+    try:
+        configure_parser(backend=config["DEFAULT"].get("parser", "lxml"),
+                         workers=config["DEFAULT"].getint("parseworkers", 0))
+
+    except ValueError as e:     # Fall back to the default parser if the config file names an unknown one
+        print(e)
 
     if args.Results:
         max_results = args.Results
@@ -89,61 +115,136 @@ def main():
         max_results = 2500
 
     if args.Sort == "Location":
-        sort = {"key": lambda x: x[2]}
+        sort = {"field": "hood"}
 
     if args.Sort == "Price Descending":
-        sort = {"key": lambda x: x[1]}
+        sort = {"field": "price"}
 
     if args.Sort == "Price Ascending":
-        sort = {"key": lambda x: x[1], "reverse": True}
+        sort = {"field": "price", "reverse": True}
 
     if args.Sort == "Date Ascending":
-        sort = {"key": lambda x: x[-1]}
+        sort = {"field": "posted" if args.Verbose else "updated"}
 
     if args.Sort == "Date Descending":
-        sort = {"key": lambda x: x[-1], "reverse": True}
+        sort = {"field": "posted" if args.Verbose else "updated", "reverse": True}
 
     if args.Sort == "Do Not Sort":
         sort = False
 
-    if not args.Sort:
-        if config["DEFAULT"]["sort"].lower() == "false":
+    if args.SortBy:
+        sort = {"field": args.SortBy}
+
+    if not args.Sort and not args.SortBy:
+        if config["DEFAULT"].get("sort", "false").lower() == "false":
             sort = False
 
-        else:
-            try:
-                    sort = exec(config["DEFAULT"]["sort"])
+        else:                   # An expression, see craigraker_expr.py
+            sort = {"field": config["DEFAULT"]["sort"], "reverse": config["DEFAULT"].getboolean("reverse", False)}
+
+    where = args.Filter or config["DEFAULT"].get("filter") or None
+
+    try:
+        if sort and sort["field"] not in FIELDS:
+            sort["field"] = compile_expression(sort["field"])
+
+    except ValueError as e:     # Show the results unsorted rather than not at all
+        print(e)
+        sort = False
+
+    try:
+        row_filter.set(compile_expression(where) if where else None)
+
+    except ValueError as e:     # Scraping everything would not be what was asked for
+        print(e)
+        return
+
+    if row_filter.get() is not None and row_filter.get().late and not args.Verbose:
+        print("The filter uses {} from the ad page, which needs Verbose".format(", ".join(
+            field for field in row_filter.get().fields if field not in SEARCH_FIELDS)))
+        return
 
-            except Exception:
-                print("Sort found in config file is not valid. ")
-                sort = False
+    filters = search_filters(min_price=args.MinPrice if args.MinPrice is not None else config["DEFAULT"].getint("minprice"),
+                             max_price=args.MaxPrice if args.MaxPrice is not None else config["DEFAULT"].getint("maxprice"),
+                             posted_today=args.PostedToday or config["DEFAULT"].getboolean("postedtoday", False),
+                             has_image=args.HasImage or config["DEFAULT"].getboolean("hasimage", False),
+                             title_only=args.TitleOnly or config["DEFAULT"].getboolean("titleonly", False),
+                             where=row_filter.get())
 
     """ This is where we scrape CL """
-    results = [result for result in scrape(search_url,
-                                           local_cl_url,
-                                           args.Query,
-                                           max_results=max_results,
-                                           verbose=args.Verbose,
-                                           wanted=False)]
+    failures = []
+    failure_log.set(failures)
+
+    progress = Progress(lambda progress: print("Progress: {}/{} {}".format(*progress.units(), progress.line()), flush=True),
+                        interval=0.5)   # Read by Gooey for its progress bar
+    progress_tracker.set(progress)
+    results = AdBatch()
+
+    def output(result):
+        """ Unsorted rows are shown as soon as they arrive. """
+        if not sort:
+            if len(results) == 0:
+                print(print_result(HEADERS))  # Headers for csv columns
+
+            print(print_result(result))
+            print(flush=True)
+
+        results.append(result)
+
+    loop = get_loop()
+    task = loop.create_task(consume(iter_scrape(search_url,
+                                                local_cl_url,
+                                                args.Query,
+                                                max_results=max_results,
+                                                verbose=args.Verbose,
+                                                wanted=False,
+                                                dedupe=None if config["DEFAULT"].getboolean("dedupe", True) else False,
+                                                filters=filters),
+                                    output))
+    cancel_on_signals(task)     # Gooey's stop button sends SIGTERM, which cancels the requests in flight
+
+    try:
+        loop.run_until_complete(task)
+
+    except asyncio.CancelledError:
+        print("Stopped. Keeping the {} results found so far".format(len(results)))
+
+    progress.finish()
 
     if sort:
-        results.sort(**sort)
+        results.sort(sort["field"], reverse=sort.get("reverse", False))
 
-    if len(results) > 0:
-        print(print_result(["Title", "Price", "Location", "Posting Information",
-                            "Email", "Phone", "Url", "Updated", "Posted"]))  # Headers for csv columns
+        if len(results) > 0:
+            print(print_result(HEADERS))  # Headers for csv columns
 
         for result in results:
             print(print_result(result))
             print()
 
+    if failures:
+        print("{} pages could not be scraped:".format(len(failures)))
+
+        for failure in failures:
+            print(failure.stage, failure.url, failure.error)
+
+    if config["DEFAULT"].getboolean("store", False):  # Keep the ads for craigraker query
+        try:
+            with AdStore() as store:
+                store.write_all(results, source=args.Query)
+
+        except ValueError as e:
+            print(e)
+
     if args.File:
-        with open(args.File, "a+") as f:
-            for result in results:
-                f.write(print_result(result))
-                f.write("\n")
+        try:
+            with open_writer(args.File) as writer:
+                writer.write_all(results)
+
+        except ValueError as e:  # Parquet without pyarrow
+            print(e)
 
-    LOOP.close()
+    close_all()
+    loop.close()
 
 
 if __name__ == "__main__":
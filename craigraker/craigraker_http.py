@@ -0,0 +1,351 @@
+#!/bin/python
+import asyncio
+import contextvars
+import random
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+
+from craigraker_stats import get_stats
+
+"""
+
+Craigraker! A really cool Craigslist scraper!
+
+The shared HTTP client used by every fetch in craigraker_functions.py.
+One pooled session is kept open for the whole run so that requests to the same
+craigslist host reuse their keep-alive connections instead of doing a new TCP and TLS handshake.
+
+Every request also goes through the scheduler, which caps the total and per host number of
+requests in flight and paces each host with a token bucket. The per host cap is a window that
+grows while the host answers quickly and shrinks when it throttles us (AIMD).
+
+Requests time out instead of hanging forever, and transient failures (timeouts, dropped connections,
+throttling and 5xx statuses) are retried with jittered exponential backoff.
+
+Author: Ethan Henderson
+https://github.com/ethan626
+
+"""
+
+USER_AGENT = ("Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) "
+              "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36")
+
+SESSION_CONFIG = {"limit": 100,             # Total number of pooled connections
+                  "limit_per_host": 20,     # Connections to any single craigslist host
+                  "ttl_dns_cache": 300,     # Seconds to keep resolved host names
+                  "keepalive_timeout": 30,  # Seconds an idle connection is kept open
+                  "connect_timeout": 10,    # Seconds to wait for a connection, including waiting for a pooled one
+                  "read_timeout": 30,       # Seconds to wait for the next chunk of a response
+                  "total_timeout": 120,     # Seconds any one request may take in all
+                  "headers": {"User-Agent": USER_AGENT}}  # Accept-Encoding is added when the session opens
+
+_session = None
+
+
+def configure_session(**config):
+    """ Change the options used to build the shared session, for example configure_session(limit_per_host=10).
+        Options take effect the next time the session is opened. """
+    headers = config.pop("headers", None)
+
+    if headers:
+        SESSION_CONFIG["headers"] = dict(SESSION_CONFIG["headers"], **headers)
+
+    SESSION_CONFIG.update(config)
+
+
+def get_session():
+    """ Returns the shared aiohttp ClientSession, opening it on first use. Must be called from within the event loop. """
+    global _session
+
+    if _session is None or _session.closed:
+        import aiohttp          # The slowest import craigraker has, so runs that never fetch don't pay for it
+
+        connector = aiohttp.TCPConnector(limit=SESSION_CONFIG["limit"],
+                                         limit_per_host=SESSION_CONFIG["limit_per_host"],
+                                         use_dns_cache=True,
+                                         ttl_dns_cache=SESSION_CONFIG["ttl_dns_cache"],
+                                         keepalive_timeout=SESSION_CONFIG["keepalive_timeout"])
+        timeout = aiohttp.ClientTimeout(total=SESSION_CONFIG["total_timeout"] or None,  # 0 for no limit
+                                        connect=SESSION_CONFIG["connect_timeout"] or None,
+                                        sock_read=SESSION_CONFIG["read_timeout"] or None)
+        _session = aiohttp.ClientSession(connector=connector, headers=dict({"Accept-Encoding": accept_encoding()},
+                                                                           **SESSION_CONFIG["headers"]), timeout=timeout)
+
+    return _session
+
+
+def accept_encoding():
+    """ aiohttp can only decode brotli responses when a brotli package is installed. """
+    try:
+        from aiohttp.compression_utils import HAS_BROTLI
+
+    except ImportError:
+        HAS_BROTLI = False
+
+    return "gzip, deflate, br" if HAS_BROTLI else "gzip, deflate"
+
+
+async def close_session():
+    """ Closes the shared session and its pooled connections. """
+    global _session
+
+    if _session is not None and not _session.closed:
+        await _session.close()
+
+    _session = None
+
+
+SCHEDULER_CONFIG = {"max_requests": 50,  # Requests in flight across all hosts
+                    "max_per_host": 10,  # Requests in flight to any single host
+                    "rate": 0,           # Requests per second to any single host, 0 for no limit
+                    "burst": 10,         # Requests a host may take at once before the rate applies
+                    "adaptive": True}    # Let the per host window adapt to latency and throttling
+
+THROTTLED = (429, 503)  # Statuses craigslist answers with when we are going too fast
+
+# A semaphore limiting the requests in flight for the job (one search of a batch) the current task belongs to.
+# Tasks inherit it from the task that created them, so every request a job makes shares the job's limit.
+job_slot = contextvars.ContextVar("job_slot", default=None)
+
+_scheduler = None
+
+
+class TokenBucket:
+    """ Paces requests to rate per second while allowing bursts of up to burst requests. """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    async def take(self):
+        """ Waits until a token is available and takes it. """
+        if not self.rate:
+            return
+
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AIMDController:
+    """ Limits the requests in flight to a host to a window that adapts to how the host is coping.
+
+        The window grows by one per round trip while responses are healthy (doubling until the first
+        sign of trouble), and is cut by the decrease factor on a 429/503 or when a response takes more
+        than latency_spike times the usual latency. At most one cut is made per round trip.
+    """
+
+    def __init__(self, max_window=10, min_window=1, initial_window=2, decrease=0.5, latency_spike=4.0, adaptive=True):
+        self.max_window = max(min_window, max_window)
+        self.min_window = min_window
+        self.window = float(min(initial_window, self.max_window) if adaptive else self.max_window)
+        self.decrease = decrease
+        self.latency_spike = latency_spike
+        self.adaptive = adaptive
+        self.slow_start = True
+        self.latency = None     # Moving average of healthy response times in seconds
+        self.samples = 0
+        self.last_cut = 0
+        self.in_flight = 0
+        self.changed = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.in_flight < int(self.window))
+            self.in_flight += 1
+
+        return self
+
+    async def __aexit__(self, *exc_info):
+        async with self.changed:
+            self.in_flight -= 1
+            self.changed.notify_all()  # The window may have grown since the waiters last checked
+
+    def record(self, latency, status):
+        """ Adjusts the window after a response that took latency seconds and returned status. """
+        if not self.adaptive:
+            return
+
+        spike = self.samples >= 5 and latency > self.latency_spike * self.latency
+
+        if status in THROTTLED or spike:
+            self.cut()
+            return
+
+        self.samples += 1
+        self.latency = latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+
+        if status < 400:
+            self.window = min(self.max_window, self.window + (1 if self.slow_start else 1 / self.window))
+
+    def cut(self):
+        """ Multiplicatively shrinks the window, once per round trip. A fixed window (not adaptive) is never cut. """
+        now = time.monotonic()
+
+        if not self.adaptive or now - self.last_cut < (self.latency or 0):
+            return
+
+        self.last_cut = now
+        self.slow_start = False
+        self.window = max(self.min_window, self.window * self.decrease)
+
+
+class Scheduler:
+    """ Every fetch asks the scheduler for a slot before it touches the network. """
+
+    def __init__(self, max_requests=50, max_per_host=10, rate=0, burst=10, adaptive=True):
+        self.max_requests = max_requests
+        self.max_per_host = max_per_host
+        self.rate = rate
+        self.burst = burst
+        self.adaptive = adaptive
+        self.total = asyncio.Semaphore(max_requests)
+        self.hosts = {}
+
+    def host(self, host):
+        """ Returns the window controller and token bucket for a host, creating them the first time it is seen. """
+        if host not in self.hosts:
+            self.hosts[host] = (AIMDController(max_window=self.max_per_host, adaptive=self.adaptive),
+                                TokenBucket(self.rate, self.burst))
+
+        return self.hosts[host]
+
+    def windows(self):
+        """ Returns the current request window of every host seen so far. """
+        return {host: controller.window for host, (controller, _) in self.hosts.items()}
+
+    @asynccontextmanager
+    async def slot(self, url):
+        """ Holds a request slot for url for the duration of the with block.
+            Yields the host's controller, which should be told how the request went. """
+        controller, bucket = self.host(urlsplit(url).netloc)
+        job = job_slot.get()
+
+        if job is not None:     # Keeps one job of a batch from taking every slot from the others
+            await job.acquire()
+
+        try:
+            async with controller:
+                await bucket.take()
+
+                async with self.total:
+                    yield controller
+
+        finally:
+            if job is not None:
+                job.release()
+
+
+def configure_scheduler(**config):
+    """ Change the limits used by the scheduler, for example configure_scheduler(rate=5).
+        The scheduler is rebuilt with the new limits on its next use. """
+    global _scheduler
+
+    SCHEDULER_CONFIG.update(config)
+    _scheduler = None
+
+
+def get_scheduler():
+    """ Returns the shared request scheduler, creating it on first use. """
+    global _scheduler
+
+    if _scheduler is None:
+        _scheduler = Scheduler(**SCHEDULER_CONFIG)
+
+    return _scheduler
+
+
+def configure_network(max_requests=None, max_per_host=None, rate=None, adaptive=None):
+    """ Sets the request limits on both the scheduler and the session's connection pool. None leaves a limit unchanged. """
+    if max_requests:
+        configure_scheduler(max_requests=max_requests)
+        configure_session(limit=max(max_requests, SESSION_CONFIG["limit"]))
+
+    if max_per_host:
+        configure_scheduler(max_per_host=max_per_host)
+        configure_session(limit_per_host=max(max_per_host, SESSION_CONFIG["limit_per_host"]))
+
+    if rate is not None:
+        configure_scheduler(rate=rate)
+
+    if adaptive is not None:
+        configure_scheduler(adaptive=adaptive)
+
+
+RETRY_CONFIG = {"retries": 3,       # Times a request is retried after a transient failure
+                "backoff": 0.5,     # Seconds to wait before the first retry, doubled for each retry after
+                "max_backoff": 30,  # Longest wait between retries in seconds
+                "hedge": 0}         # Seconds before a slow search page is requested a second time, 0 to never hedge
+
+RETRY_STATUSES = THROTTLED + (500, 502, 504)  # Statuses worth trying again
+
+
+def configure_retries(**config):
+    """ Change the retry policy, for example configure_retries(retries=5, hedge=2). """
+    RETRY_CONFIG.update(config)
+
+
+def transient(error):
+    """ Returns True if a request that failed with error may succeed if tried again. """
+    import aiohttp
+
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in RETRY_STATUSES
+
+    return isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError))
+
+
+def retry_after(error):
+    """ Returns the seconds a throttled response asked us to wait in its Retry-After header, or None. """
+    headers = getattr(error, "headers", None) or {}
+
+    try:
+        return float(headers.get("Retry-After"))
+
+    except (TypeError, ValueError):  # Missing, or given as a date
+        return None
+
+
+def backoff_delay(attempt, error=None):
+    """ Returns the seconds to wait before retry number attempt (from 0). The delay is drawn at random
+        from up to backoff * 2 ** attempt so that requests that failed together do not all retry together. """
+    delay = random.uniform(0, min(RETRY_CONFIG["max_backoff"], RETRY_CONFIG["backoff"] * 2 ** attempt))
+
+    return max(delay, min(RETRY_CONFIG["max_backoff"], retry_after(error) or 0))
+
+
+async def hedged(request, delay):
+    """ Awaits request(), and if it has not finished after delay seconds starts a second request() alongside it.
+        Returns whichever succeeds first and cancels the other. Raises if both fail. """
+    tasks = {asyncio.ensure_future(request())}
+
+    try:
+        done, tasks = await asyncio.wait(tasks, timeout=delay)
+
+        if not done:
+            get_stats().count("hedges")
+            tasks.add(asyncio.ensure_future(request()))
+
+        while True:
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+
+            if not tasks:       # Everything failed, raise the last failure
+                return task.result()
+
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+
+    finally:
+        for task in tasks:
+            task.cancel()
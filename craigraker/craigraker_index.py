@@ -0,0 +1,100 @@
+#!/bin/python
+import re
+import sqlite3
+from os import makedirs
+from os.path import dirname, expanduser
+
+"""
+
+Craigraker! A really cool Craigslist scraper!
+
+The seen-ads index used by the --watch and --newonly modes.
+For every search it remembers each ad url and the date the ad was last updated,
+so that later scrapes of the same search only visit ads that are new or have changed.
+
+Within a run, the Deduplicator drops ads already found on another page or in another city
+(craigslist cross-posts and reposts, and pages shift while we scrape), before their ad pages are fetched.
+
+Author: Ethan Henderson
+https://github.com/ethan626
+
+"""
+
+INDEX_PATH = "~/.cache/craigraker/seen.sqlite3"
+
+
+class SeenIndex:
+    """ A persistent map of (search, ad url) to the ad's last updated date. """
+
+    def __init__(self, search, path=INDEX_PATH):
+        self.search = search
+        self.path = expanduser(path)
+        self.skipped = 0        # Ads skipped because they have not changed since they were last seen
+
+        makedirs(dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS seen (search TEXT, url TEXT, updated TEXT, PRIMARY KEY (search, url))")
+
+    def changed(self, url, updated):
+        """ Returns True if the ad is new or has been updated since it was last seen. """
+        row = self.db.execute("SELECT updated FROM seen WHERE search = ? AND url = ?", (self.search, url)).fetchone()
+
+        if row is not None and row[0] == str(updated):
+            self.skipped += 1
+            return False
+
+        return True
+
+    def mark(self, results):
+        """ Remembers the ads in a list of scraped results. """
+        self.db.executemany("INSERT OR REPLACE INTO seen VALUES (?, ?, ?)",
+                            [(self.search, result.url, str(result.updated)) for result in results if result.url is not None])
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+POSTING_ID = re.compile(r"(\d+)\.html")   # .../fuo/d/some-title/7012345678.html
+
+
+def posting_id(url):
+    """ Returns the craigslist posting id in an ad url, or the url itself if it has none. """
+    match = POSTING_ID.search(url or "")
+
+    return match.group(1) if match else url
+
+
+def fingerprint(ad):
+    """ Returns what a repost of ad would have in common with it, its title, price and neighborhood. None without a title. """
+    if not ad.title:
+        return None
+
+    return " ".join(ad.title.lower().split()), ad.price, (ad.hood or "").strip().lower()
+
+
+class Deduplicator:
+    """ Remembers the ads found so far in a run, by posting id and by fingerprint.
+        One is shared by every page of a run, so the first page to find an ad keeps it. """
+
+    def __init__(self):
+        self.ids = set()
+        self.fingerprints = set()
+        self.duplicates = 0
+
+    def first(self, ad):
+        """ Returns True, and remembers the ad, if no ad with its posting id or fingerprint has been seen. """
+        key, content = posting_id(ad.url), fingerprint(ad)
+
+        if (key is not None and key in self.ids) or (content is not None and content in self.fingerprints):
+            self.duplicates += 1
+            return False
+
+        self.ids.add(key)
+        self.fingerprints.add(content)
+
+        return True
+
+    def unique(self, ads):
+        """ Returns the ads not seen before, in order. Duplicates within ads are dropped too. """
+        return [ad for ad in ads if self.first(ad)]
@@ -0,0 +1,208 @@
+#!/bin/python
+import csv
+import io
+import json
+from datetime import datetime
+from os.path import exists, getsize, splitext
+
+from craigraker_results import AdBatch, FIELDS, HEADERS, sortable
+
+"""
+
+Craigraker! A really cool Craigslist scraper!
+
+How results are printed, and the writers used for --file. Rows are buffered and written in batches of batch_size,
+so long runs stream to disk without a write per row.
+
+    csv -- RFC 4180 csv with real quoting, appended to the file. Missing values are empty.
+    ndjson -- one json object per line, appended to the file.
+    parquet -- a parquet file, one row group per batch. Needs the optional pyarrow package.
+
+Pages that could not be scraped are written with write_failures, for --failures.
+
+Author: Ethan Henderson
+https://github.com/ethan626
+
+"""
+
+RESULT_COLORS = {9: ["white", "red", "yellow", "green", "blue", "cyan", "magenta", "white", "red"],
+                 6: ["white", "red", "yellow", "green", "blue", "cyan"],
+                 5: ["white", "red", "yellow", "green", "cyan"],
+                 4: ["white", "red", "yellow", "green"]}
+
+
+def print_result(result, color=False):
+    """ Print the scraped data as a line of csv, colored with ANSI colors """
+    result = ["None" if value is None else value for value in result]
+
+    if color:
+        from termcolor import colored
+
+        colors = RESULT_COLORS.get(len(result), RESULT_COLORS[9])
+        result = [colored(value, colors[i % len(colors)]) for i, value in enumerate(result)]
+
+    line = io.StringIO()
+    csv.writer(line, lineterminator="").writerow(result)  # Quotes any field with a comma in it
+
+    return line.getvalue()
+
+
+FORMATS = ("csv", "ndjson", "parquet")
+
+EXTENSIONS = {".csv": "csv", ".ndjson": "ndjson", ".jsonl": "ndjson", ".json": "ndjson", ".parquet": "parquet"}
+
+
+class Writer:
+    """ Buffers rows and hands them to write_rows in batches. Subclasses write the batches. """
+
+    def __init__(self, path, batch_size=500, tagged=False):
+        self.path = path
+        self.batch_size = batch_size
+        self.tagged = tagged        # Rows start with the name of the search they came from, see --batch
+        self.rows = []
+
+    def write(self, ad, source=None):
+        """ Queues one ad, source is the name of the search it came from when tagged. """
+        self.rows.append(([source] if self.tagged else []) + list(ad))
+
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def write_all(self, ads, source=None):
+        for ad in ads:
+            self.write(ad, source=source)
+
+    def headers(self):
+        return (["Search"] if self.tagged else []) + HEADERS
+
+    def flush(self):
+        if self.rows:
+            self.write_rows(self.rows)
+            self.rows = []
+
+    def write_rows(self, rows):
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CsvWriter(Writer):
+    """ Appends RFC 4180 csv, with a header row when the file is new. """
+
+    def __init__(self, path, batch_size=500, tagged=False):
+        super().__init__(path, batch_size=batch_size, tagged=tagged)
+        new = not exists(path) or getsize(path) == 0
+        self.file = open(path, "a", newline="", encoding="utf-8")
+        self.csv = csv.writer(self.file)
+
+        if new:
+            self.csv.writerow(self.headers())
+
+    def write_rows(self, rows):
+        self.csv.writerows(rows)    # None is written as an empty field
+        self.file.flush()
+
+    def close(self):
+        super().close()
+        self.file.close()
+
+
+def json_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+
+    return value
+
+
+class NdjsonWriter(Writer):
+    """ Appends one json object per ad, keyed by field name. """
+
+    def __init__(self, path, batch_size=500, tagged=False):
+        super().__init__(path, batch_size=batch_size, tagged=tagged)
+        self.file = open(path, "a", encoding="utf-8")
+        self.keys = (["search"] if tagged else []) + list(FIELDS)
+
+    def write_rows(self, rows):
+        self.file.write("".join(json.dumps(dict(zip(self.keys, map(json_value, row))), ensure_ascii=False) + "\n"
+                                for row in rows))
+        self.file.flush()
+
+    def close(self):
+        super().close()
+        self.file.close()
+
+
+class ParquetWriter(Writer):
+    """ Writes a parquet file, replacing any file already at path. Each batch is one row group. """
+
+    def __init__(self, path, batch_size=5000, tagged=False):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+
+        except ImportError:
+            raise ValueError("Writing parquet needs pyarrow, install it with pip install pyarrow")
+
+        super().__init__(path, batch_size=batch_size, tagged=tagged)
+        self.pyarrow = pyarrow
+        self.keys = (["search"] if tagged else []) + list(FIELDS)
+        types = {"price": pyarrow.float64(), "updated": pyarrow.timestamp("s"), "posted": pyarrow.timestamp("s")}
+        self.schema = pyarrow.schema([(key, types.get(key, pyarrow.string())) for key in self.keys])
+        self.file = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write_rows(self, rows):
+        columns = [list(column) for column in zip(*rows)]
+        self.write_columns(dict(zip(self.keys, columns)))
+
+    def write_columns(self, columns):
+        """ Writes a row group straight from columns of values, keyed by field name. """
+        for key in ("updated", "posted"):  # Parquet timestamps can't mix naive and aware dates
+            columns[key] = [sortable(value) if isinstance(value, datetime) else None for value in columns[key]]
+
+        self.file.write_table(self.pyarrow.Table.from_pydict(columns, schema=self.schema))
+
+    def write_all(self, ads, source=None):
+        if isinstance(ads, AdBatch):    # Already in columns, skip building rows
+            self.flush()
+            columns = {field: ads.column(field) for field in FIELDS}
+
+            if self.tagged:
+                columns["search"] = [source] * len(ads)
+
+            if len(ads):
+                self.write_columns(columns)
+
+            return
+
+        super().write_all(ads, source=source)
+
+    def close(self):
+        super().close()
+        self.file.close()
+
+
+WRITERS = {"csv": CsvWriter, "ndjson": NdjsonWriter, "parquet": ParquetWriter}
+
+
+def open_writer(path, format=None, tagged=False):
+    """ Opens a writer for path. The format is guessed from the file extension if not given, csv if it can't be.
+        Raises ValueError for an unknown format, or parquet without pyarrow. """
+    format = format or EXTENSIONS.get(splitext(path)[1].lower(), "csv")
+
+    if format not in WRITERS:
+        raise ValueError("Unknown output format {}, choose one of {}".format(format, ", ".join(FORMATS)))
+
+    return WRITERS[format](path, tagged=tagged)
+
+
+def write_failures(path, failures):
+    """ Appends Failures to path, one json object per line. """
+    with open(path, "a", encoding="utf-8") as file:
+        file.write("".join(json.dumps(failure.as_dict(), ensure_ascii=False) + "\n" for failure in failures))
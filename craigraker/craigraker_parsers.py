@@ -0,0 +1,324 @@
+#!/bin/python
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache, partial
+
+from craigraker_results import Ad
+from craigraker_stats import get_stats
+
+"""
+
+Craigraker! A really cool Craigslist scraper!
+
+The html parsers used by craigraker_functions.py. Each page type has a parser for
+two backends that give the same results:
+
+    lxml -- compiled XPath expressions run straight on the lxml tree. The default, and the fastest.
+    soup -- BeautifulSoup, limited to the parts of the page that are needed.
+
+Parsing can be moved off the event loop into a pool of worker processes (or threads),
+so that sockets keep being serviced while pages are parsed and big scrapes use every core.
+Pages shorter than inline_below characters are still parsed inline, where a round trip to the pool costs more than it saves.
+
+Author: Ethan Henderson
+https://github.com/ethan626
+
+"""
+
+PARSER_CONFIG = {"backend": "lxml",
+                 "workers": 0,              # Parsing workers, 0 parses everything inline on the event loop
+                 "pool": "process",         # "process" or "thread"
+                 "inline_below": 20000}     # Pages smaller than this many characters are parsed inline
+
+BACKENDS = ("lxml", "soup")
+
+POOLS = ("process", "thread")
+
+_executor = None
+
+
+def configure_parser(backend=None, workers=None, pool=None, inline_below=None):
+    """ Chooses the parsing backend, "lxml" or "soup", and how many workers parse pages off the event loop.
+        None leaves an option unchanged. """
+    if backend is not None and backend not in BACKENDS:
+        raise ValueError("Unknown parser backend {}, choose one of {}".format(backend, ", ".join(BACKENDS)))
+
+    if pool is not None and pool not in POOLS:
+        raise ValueError("Unknown parser pool {}, choose one of {}".format(pool, ", ".join(POOLS)))
+
+    for option, value in (("backend", backend), ("workers", workers), ("pool", pool), ("inline_below", inline_below)):
+        if value is not None:
+            PARSER_CONFIG[option] = value
+
+    close_parser_pool()         # The pool is rebuilt with the new options on its next use
+
+
+def parse_datetime(text):
+    """ Parses a date from craigslist. The ISO dates craigslist uses skip dateutil entirely. """
+    try:
+        date = datetime.fromisoformat(text.strip())
+        get_stats().count("dates", "iso")
+        return date
+
+    except ValueError:
+        from dateutil.parser import parse   # Imported on first use, most runs never need it
+
+        with get_stats().timer("dateutil"):
+            return parse(text)
+
+
+def clean_price(text):
+    """ "$1,200" -> 1200.0 """
+    return float(text.strip().replace("(", "").replace(")", "").replace("$", "").replace(",", "").replace("\n", ""))
+
+
+def clean_hood(text):
+    """ " (Capitol Hill)" -> "Capitol Hill" """
+    return text.strip().replace("(", "").replace(")", "").replace("\n", "")
+
+
+def clean_title(text):
+    return text.strip().replace("\n", "")
+
+
+def clean_page_text(text):
+    text = text.replace("\n\nQR Code Link to This Post\n\n\n", "")  # Remove the junk
+    return text.replace("\n", "").strip()
+
+
+def search_result(title, price, hood, url, updated):
+    """ Returns an Ad with what a search page shows, the rest is filled in from the ad's own page. """
+    return Ad(title=title, price=price, hood=hood, url=url, updated=updated)
+
+
+""" lxml backend """
+
+
+def has_class(name):
+    """ XPath test for an element with name among its classes. """
+    return 'contains(concat(" ", normalize-space(@class), " "), " {} ")'.format(name)
+
+
+XPATHS = {"result_info": '//p[{}]'.format(has_class("result-info")),
+          "price": './/span[{}]'.format(has_class("result-price")),
+          "hood": './/span[{}]'.format(has_class("result-hood")),
+          "title": './/a[@class="result-title hdrlnk"]',
+          "result_date": './/time[{}]/@datetime'.format(has_class("result-date")),
+          "total_count": '//span[{}]'.format(has_class("totalcount")),
+          "posting_body": '//section[@id="postingbody"]',
+          "posted": '//time[@class="date timeago"]',
+          "reply_link": '//a[@id="replylink"]/@href',
+          "email": '//p[{}]'.format(has_class("anonemail")),
+          "phone": '//p[{}]'.format(has_class("reply-tel-number")),
+          "text": './/text()[not(ancestor::script) and not(ancestor::style)]'}
+
+
+@lru_cache(maxsize=None)
+def xpath(name):
+    """ The compiled XPath for one of XPATHS. They are compiled on first use, so lxml is not imported until a page is parsed. """
+    from lxml import etree
+
+    return etree.XPath(XPATHS[name])
+
+
+def document(html):
+    """ Parses html into an lxml tree. Returns None for an empty page. """
+    import lxml.html
+    from lxml import etree
+
+    try:
+        return lxml.html.fromstring(html)
+
+    except (etree.ParserError, ValueError):
+        return None
+
+
+def text(element):
+    """ The text of an element and its children, like BeautifulSoup's .text """
+    return "".join(xpath("text")(element))
+
+
+def lxml_search_page(html, wanted=False, max_results=120):
+    return lxml_search_results(document(html), wanted=wanted, max_results=max_results)
+
+
+def lxml_search_results(tree, wanted=False, max_results=120):
+    results = []
+
+    if tree is None:
+        return results
+
+    for ad in xpath("result_info")(tree)[:max_results]:
+        if wanted and "wanted" in text(ad).lower():  # Ignore wanted ads
+            continue
+
+        prices, hoods, titles, dates = xpath("price")(ad), xpath("hood")(ad), xpath("title")(ad), xpath("result_date")(ad)
+        results.append(search_result(clean_title(text(titles[-1])) if titles else None,
+                                     clean_price(text(prices[-1])) if prices else None,
+                                     clean_hood(text(hoods[-1])) if hoods else None,
+                                     titles[-1].get("href") if titles else None,
+                                     parse_datetime(dates[-1]) if dates else None))
+
+    return results
+
+
+def lxml_ad_page(html):
+    tree = document(html)
+
+    if tree is None:
+        return None, None, None
+
+    body, posted, reply = xpath("posting_body")(tree), xpath("posted")(tree), xpath("reply_link")(tree)
+
+    return (clean_page_text(text(body[0])) if body else None,
+            parse_datetime(text(posted[0])) if posted else None,
+            reply[-1] if reply else None)
+
+
+def lxml_contact_page(html):
+    tree = document(html)
+
+    if tree is None:
+        return None, None
+
+    emails, phones = xpath("email")(tree), xpath("phone")(tree)
+
+    return (text(emails[-1]) if emails else None,
+            text(phones[-1]) if phones else None)
+
+
+def lxml_first_page(html, wanted=False, max_results=120):
+    tree = document(html)
+    totals = xpath("total_count")(tree) if tree is not None else []
+
+    return (int(text(totals[0])) if totals else None,
+            lxml_search_results(tree, wanted=wanted, max_results=max_results))
+
+
+""" BeautifulSoup backend, bs4 is only imported once it is used """
+
+
+def bs(html, features, parse_only=None):
+    from bs4 import BeautifulSoup
+
+    return BeautifulSoup(html, features, parse_only=parse_only)
+
+
+@lru_cache(maxsize=None)
+def strainer(name, class_):
+    """ Only build the parts of a page we read. """
+    from bs4 import SoupStrainer
+
+    return SoupStrainer(name, class_=class_)
+
+
+def soup_search_page(html, wanted=False, max_results=120):
+    soup = bs(html, "lxml", parse_only=strainer("p", "result-info"))
+    results = []
+
+    for ad in soup("p", {"class": "result-info"})[:max_results]:
+        if wanted and "wanted" in ad.text.lower():  # Ignore wanted ads
+            continue
+
+        prices = ad("span", {"class": "result-price"})
+        hoods = ad("span", {"class": "result-hood"})
+        titles = ad("a", {"class": "result-title hdrlnk"})
+        dates = ad("time", {"class": "result-date"})
+
+        results.append(search_result(clean_title(titles[-1].text) if titles else None,
+                                     clean_price(prices[-1].text) if prices else None,
+                                     clean_hood(hoods[-1].text) if hoods else None,
+                                     titles[-1]["href"] if titles else None,
+                                     parse_datetime(dates[-1]["datetime"]) if dates else None))
+
+    return results
+
+
+def soup_ad_page(html):
+    soup = bs(html, "lxml")
+    body, posted, reply = soup("section", {"id": "postingbody"}), soup("time", class_="date timeago"), soup("a", {"id": "replylink"})
+
+    return (clean_page_text(body[0].text) if body else None,
+            parse_datetime(posted[0].text) if posted else None,
+            reply[-1]["href"] if reply else None)
+
+
+def soup_contact_page(html):
+    soup = bs(html, "lxml")
+    emails, phones = soup("p", class_="anonemail"), soup("p", class_="reply-tel-number")
+
+    return (emails[-1].text if emails else None,
+            phones[-1].text if phones else None)
+
+
+def soup_first_page(html, wanted=False, max_results=120):
+    totals = bs(html, "lxml", parse_only=strainer("span", "totalcount"))("span", class_="totalcount")
+
+    return (int(totals[0].text) if totals else None,
+            soup_search_page(html, wanted=wanted, max_results=max_results))
+
+
+""" The parsers used by craigraker_functions.py, they call the configured backend. """
+
+PARSERS = {"lxml": {"search": lxml_search_page, "ad": lxml_ad_page, "contact": lxml_contact_page, "first": lxml_first_page},
+           "soup": {"search": soup_search_page, "ad": soup_ad_page, "contact": soup_contact_page, "first": soup_first_page}}
+
+
+def parse_search_page(html, wanted=False, max_results=120):
+    """ Returns an Ad for each ad on a search page, with the title, price, hood, url and updated date filled in. """
+    return PARSERS[PARSER_CONFIG["backend"]]["search"](html, wanted=wanted, max_results=max_results)
+
+
+def parse_ad_page(html):
+    """ Returns (page text, date posted, reply link) for an ad page, None for anything missing. """
+    return PARSERS[PARSER_CONFIG["backend"]]["ad"](html)
+
+
+def parse_contact_page(html):
+    """ Returns (email, phone) from an ad's reply page, None for anything missing. """
+    return PARSERS[PARSER_CONFIG["backend"]]["contact"](html)
+
+
+def parse_first_page(html, wanted=False, max_results=120):
+    """ Returns (total number of results, ads) for the first page of a search, from one parse of the page.
+        The total is None if the page does not report one. """
+    return PARSERS[PARSER_CONFIG["backend"]]["first"](html, wanted=wanted, max_results=max_results)
+
+
+def get_parser_pool():
+    """ Returns the pool pages are parsed in, creating it on first use. Returns None when parsing inline. """
+    global _executor
+
+    if _executor is None and PARSER_CONFIG["workers"]:
+        if PARSER_CONFIG["pool"] == "thread":  # lxml lets go of the GIL while it parses, so threads help too
+            _executor = ThreadPoolExecutor(max_workers=PARSER_CONFIG["workers"])
+
+        else:
+            _executor = ProcessPoolExecutor(max_workers=PARSER_CONFIG["workers"])
+
+    return _executor
+
+
+def close_parser_pool(wait=False):
+    """ Shuts down the parsing pool, if there is one. Wait for the workers to exit when the interpreter is about to,
+        or its exit handler can find the pool's pipes already closed. """
+    global _executor
+
+    if _executor is not None:
+        _executor.shutdown(wait=wait)
+
+    _executor = None
+
+
+async def parse_async(page, html, **kwargs):
+    """ Parses html with the configured backend's parser for page ("search", "ad", "contact" or "first").
+        Big pages are parsed in the pool, so only the small parsed result crosses back to the event loop. """
+    parser = PARSERS[PARSER_CONFIG["backend"]][page]  # Chosen here, the workers may not share our config
+    pool = get_parser_pool() if len(html) >= PARSER_CONFIG["inline_below"] else None
+
+    with get_stats().timer("parse", page):  # Includes waiting for a free worker
+        if pool is None:
+            return parser(html, **kwargs)
+
+        return await asyncio.get_event_loop().run_in_executor(pool, partial(parser, html, **kwargs))
@@ -0,0 +1,120 @@
+#!/bin/python
+import signal
+import sys
+import time
+
+"""
+
+Craigraker! A really cool Craigslist scraper!
+
+Progress of a running scrape, for the GUI and the --progress bar of craigraker.py.
+Set a Progress as progress_tracker (in craigraker_functions.py) before starting a scrape and the
+engine keeps it up to date as search pages, ads, bytes and errors come in. Its listener is called
+with it every interval seconds at most, and once more when it is finished.
+
+The work of a scrape is its search pages plus its ads. The number of ads is known once the first page
+gives the total, ads are done once their page is parsed, or with verbose once their ad page is visited.
+
+Author: Ethan Henderson
+https://github.com/ethan626
+
+"""
+
+
+class Progress:
+    """ How far a scrape has got. listener is called with the Progress as it changes. """
+
+    def __init__(self, listener=None, interval=0.2):
+        self.listener = listener
+        self.interval = interval
+        self.started = time.monotonic()
+        self.notified = 0
+        self.finished = False
+        self.pages = 0          # Search pages to scrape
+        self.pages_done = 0
+        self.expected = 0       # Ads the searches said they have
+        self.ads = 0            # Ads found so far
+        self.ads_done = 0
+        self.bytes = 0
+        self.errors = 0
+
+    def update(self, **counts):
+        """ Adds to the counts, for example update(pages_done=1). """
+        for name, n in counts.items():
+            setattr(self, name, getattr(self, name) + n)
+
+        now = time.monotonic()
+
+        if self.listener is not None and now - self.notified >= self.interval:
+            self.notified = now
+            self.listener(self)
+
+    def finish(self):
+        self.finished = True
+
+        if self.listener is not None:
+            self.listener(self)
+
+    def units(self):
+        """ Returns (done, total) units of work, a unit being a search page or an ad. """
+        total = self.pages + max(self.expected, self.ads)
+        done = self.pages_done + self.ads_done
+
+        return (total, total) if self.finished else (done, total)
+
+    def fraction(self):
+        done, total = self.units()
+        return done / total if total else (1.0 if self.finished else 0.0)
+
+    def eta(self):
+        """ Seconds left, guessed from the rate so far. None until there is a rate to go on. """
+        fraction = self.fraction()
+
+        if not 0 < fraction < 1:
+            return 0 if self.finished else None
+
+        return (time.monotonic() - self.started) * (1 - fraction) / fraction
+
+    def line(self):
+        """ A one line summary, such as "3/21 pages, 360/2500 ads, 1.2 MB, 1 error, about 40s left". """
+        parts = ["{}/{} pages".format(self.pages_done, self.pages),
+                 "{}/{} ads".format(self.ads_done, max(self.expected, self.ads)),
+                 "{:.1f} MB".format(self.bytes / 1024 / 1024)]
+
+        if self.errors:
+            parts.append("{} error{}".format(self.errors, "" if self.errors == 1 else "s"))
+
+        eta = self.eta()
+
+        if eta is not None and not self.finished:
+            parts.append("about {:.0f}s left".format(eta))
+
+        return ", ".join(parts)
+
+
+def progress_bar(stream=sys.stderr, width=30):
+    """ Returns a listener that draws a progress bar on one line of stream, a terminal. """
+    def draw(progress):
+        filled = int(progress.fraction() * width)
+        stream.write("\r[{}{}] {:3.0f}% {}\033[K".format("#" * filled, " " * (width - filled), progress.fraction() * 100,
+                                                        progress.line()))
+
+        if progress.finished:
+            stream.write("\n")
+
+        stream.flush()
+
+    return draw
+
+
+def cancel_on_signals(task, signals=(signal.SIGINT, signal.SIGTERM)):
+    """ Cancels task, which must be on the running loop, when the process is sent one of signals. Cancelling it
+        cancels the requests it has in flight, so the scrape stops cleanly and what it found so far can be kept. """
+    loop = task.get_loop()
+
+    for number in signals:
+        try:
+            loop.add_signal_handler(number, task.cancel)
+
+        except (NotImplementedError, RuntimeError):  # Windows has no loop signal handlers
+            signal.signal(number, lambda *_: loop.call_soon_threadsafe(task.cancel))
@@ -0,0 +1,218 @@
+#!/bin/python
+import asyncio
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from os import makedirs
+from os.path import dirname, expanduser
+
+"""
+
+Craigraker! A really cool Craigslist scraper!
+
+The work queues used to spread a scrape over worker processes, see craigraker_worker.py.
+A coordinator puts jobs on a queue, workers take them, run them and complete them with their results
+and any jobs that follow on from them. A job is leased to the worker that takes it, so a job whose
+worker dies is taken again once its lease runs out, and a job that keeps failing is given up on.
+A queue call can wait on another process's lock, so workers and coordinators make them through
+call(), in a thread of the queue's own, keeping their event loop free.
+
+SqliteQueue keeps the queue in one SQLite file, so it needs no other service. Every process that
+shares the file shares the queue. Other backends implement WorkQueue and are added to QUEUES.
+
+Author: Ethan Henderson
+https://github.com/ethan626
+
+"""
+
+QUEUE_PATH = "~/.cache/craigraker/queue.sqlite3"
+
+STALE_RUN = 60      # Seconds without word from a run's coordinator before it is taken to have gone away
+
+
+class WorkQueue:
+    """ What a queue backend has to do. Jobs and results are dicts that can be written as json.
+        Jobs are put for a run, one run per coordinator, so several coordinators can share a queue. """
+
+    _thread = None
+
+    async def call(self, method, *args, **kwargs):
+        """ Runs one of the queue's methods, for example await queue.call(queue.take, worker, lease), in a thread of the
+            queue's own, so waiting on another process's lock never holds up the event loop. Calls run one at a time. """
+        if self._thread is None:
+            self._thread = ThreadPoolExecutor(max_workers=1)
+
+        return await asyncio.get_event_loop().run_in_executor(self._thread, partial(method, *args, **kwargs))
+
+    def put(self, run, jobs):
+        """ Adds jobs, a list of (kind, key, payload). A job with the same key as one already in the run is left out,
+            a key of None is never a duplicate. Also counts as word from the run's coordinator, see touch. """
+        raise NotImplementedError
+
+    def touch(self, run):
+        """ Notes that the coordinator of run is still waiting on it. """
+        raise NotImplementedError
+
+    def take(self, worker, lease):
+        """ Leases the next job to worker for lease seconds. Returns (id, kind, payload, attempts) or None if there is no work. """
+        raise NotImplementedError
+
+    def extend(self, ids, worker, lease):
+        """ Renews worker's leases on the jobs ids, for jobs still running. """
+        raise NotImplementedError
+
+    def complete(self, id, worker, results=(), jobs=()):
+        """ Finishes a job with its results, a list of (kind, payload), and the jobs that follow from it.
+            Returns False, keeping nothing, if the job's lease ran out and it was given to another worker. """
+        raise NotImplementedError
+
+    def fail(self, id, worker, error, retry_in=None):
+        """ Gives a job back after an error. It is tried again after retry_in seconds, or failed for good if retry_in is None. """
+        raise NotImplementedError
+
+    def results(self, run, after=0):
+        """ Returns the results of run added after the result id after, as a list of (id, kind, payload). """
+        raise NotImplementedError
+
+    def failed(self, run):
+        """ Returns the jobs of run that failed for good, as a list of (kind, payload, error). """
+        raise NotImplementedError
+
+    def pending(self, run=None, stale=None):
+        """ Returns how many jobs of run, or of every run, are waiting or running. With stale, runs whose coordinator has not
+            been heard from in stale seconds are left out, as their coordinator has most likely gone. """
+        raise NotImplementedError
+
+    def forget(self, run):
+        """ Deletes the jobs and results of run. """
+        raise NotImplementedError
+
+    def close(self):
+        if self._thread is not None:
+            self._thread.shutdown(wait=True)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, run TEXT, kind TEXT, key TEXT, payload TEXT, state TEXT DEFAULT 'ready',
+                                 attempts INTEGER DEFAULT 0, worker TEXT, due REAL DEFAULT 0, error TEXT, UNIQUE (run, key));
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, due);
+CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY, run TEXT, kind TEXT, payload TEXT);
+CREATE INDEX IF NOT EXISTS results_run ON results (run, id);
+CREATE TABLE IF NOT EXISTS runs (run TEXT PRIMARY KEY, seen REAL);
+"""
+
+
+class SqliteQueue(WorkQueue):
+    """ A queue kept in an SQLite file. due is when a ready job may next be taken, or when a running job's lease runs out. """
+
+    def __init__(self, path=QUEUE_PATH, max_attempts=3):
+        self.path = expanduser(path)
+        self.max_attempts = max_attempts
+        makedirs(dirname(self.path) or ".", exist_ok=True)
+
+        # Transactions are begun by hand. Calls may come from the queue's thread, see call, but never two at once
+        self.db = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")      # Workers read while another process writes
+        self.db.executescript(SCHEMA)
+
+    def transaction(self):
+        """ A write transaction, taken at the start so two workers can never take the same job. """
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def put(self, run, jobs):
+        with self.transaction() as db:
+            db.execute("INSERT OR REPLACE INTO runs (run, seen) VALUES (?, ?)", (run, time.time()))
+            db.executemany("INSERT OR IGNORE INTO jobs (run, kind, key, payload) VALUES (?, ?, ?, ?)",
+                           [(run, kind, key, json.dumps(payload)) for kind, key, payload in jobs])
+
+    def touch(self, run):
+        with self.transaction() as db:
+            db.execute("INSERT OR REPLACE INTO runs (run, seen) VALUES (?, ?)", (run, time.time()))
+
+    def take(self, worker, lease):
+        now = time.time()
+
+        with self.transaction() as db:
+            db.execute("UPDATE jobs SET state = 'failed', error = 'Its worker was lost too many times' "
+                       "WHERE state = 'running' AND due < ? AND attempts >= ?", (now, self.max_attempts))
+            job = db.execute("UPDATE jobs SET state = 'running', worker = ?, due = ?, attempts = attempts + 1 "
+                             "WHERE id = (SELECT id FROM jobs WHERE state IN ('ready', 'running') AND due <= ? ORDER BY id LIMIT 1) "
+                             "RETURNING id, kind, payload, attempts", (worker, now + lease, now)).fetchall()
+
+        if not job:
+            return None
+
+        id, kind, payload, attempts = job[0]
+        return id, kind, json.loads(payload), attempts
+
+    def extend(self, ids, worker, lease):
+        with self.transaction() as db:
+            db.executemany("UPDATE jobs SET due = ? WHERE id = ? AND worker = ? AND state = 'running'",
+                           [(time.time() + lease, id, worker) for id in ids])
+
+    def complete(self, id, worker, results=(), jobs=()):
+        with self.transaction() as db:
+            run = db.execute("UPDATE jobs SET state = 'done' WHERE id = ? AND worker = ? AND state = 'running' RETURNING run",
+                             (id, worker)).fetchall()
+
+            if not run:         # Someone else has it now, and their results will count instead
+                return False
+
+            run = run[0][0]
+            db.executemany("INSERT INTO results (run, kind, payload) VALUES (?, ?, ?)",
+                           [(run, kind, json.dumps(payload)) for kind, payload in results])
+            db.executemany("INSERT OR IGNORE INTO jobs (run, kind, key, payload) VALUES (?, ?, ?, ?)",
+                           [(run, kind, key, json.dumps(payload)) for kind, key, payload in jobs])
+
+        return True
+
+    def fail(self, id, worker, error, retry_in=None):
+        with self.transaction() as db:
+            db.execute("UPDATE jobs SET state = CASE WHEN ? AND attempts < ? THEN 'ready' ELSE 'failed' END, due = ?, error = ? "
+                       "WHERE id = ? AND worker = ? AND state = 'running'",
+                       (retry_in is not None, self.max_attempts, time.time() + (retry_in or 0), error, id, worker))
+
+    def results(self, run, after=0):
+        return [(id, kind, json.loads(payload)) for id, kind, payload in
+                self.db.execute("SELECT id, kind, payload FROM results WHERE run = ? AND id > ? ORDER BY id", (run, after))]
+
+    def failed(self, run):
+        return [(kind, json.loads(payload), error) for kind, payload, error in
+                self.db.execute("SELECT kind, payload, error FROM jobs WHERE run = ? AND state = 'failed' ORDER BY id", (run,))]
+
+    def pending(self, run=None, stale=None):
+        where, args = "state IN ('ready', 'running')", []
+
+        if run is not None:
+            where, args = where + " AND run = ?", args + [run]
+
+        if stale is not None:
+            where, args = where + " AND run IN (SELECT run FROM runs WHERE seen >= ?)", args + [time.time() - stale]
+
+        return self.db.execute("SELECT count(*) FROM jobs WHERE " + where, args).fetchone()[0]
+
+    def forget(self, run):
+        with self.transaction() as db:
+            db.execute("DELETE FROM jobs WHERE run = ?", (run,))
+            db.execute("DELETE FROM results WHERE run = ?", (run,))
+            db.execute("DELETE FROM runs WHERE run = ?", (run,))
+
+    def close(self):
+        super().close()
+        self.db.close()
+
+
+QUEUES = {"sqlite": SqliteQueue}
+
+
+def open_queue(spec=QUEUE_PATH, max_attempts=3):
+    """ Opens a queue from a spec of backend:location, for example sqlite:/tmp/queue.sqlite3. A bare path is an SQLite queue. """
+    backend, _, location = spec.partition(":")
+
+    if backend not in QUEUES or not location:
+        backend, location = "sqlite", spec
+
+    return QUEUES[backend](location, max_attempts=max_attempts)
@@ -0,0 +1,161 @@
+#!/bin/python
+from array import array
+from datetime import datetime
+from math import isnan
+
+"""
+
+Craigraker! A really cool Craigslist scraper!
+
+The records scraped ads are kept in.
+
+    Ad -- one scraped ad. Fields that could not be found are None.
+    AdBatch -- many ads stored column by column, for sorting and writing large result sets.
+    Failure -- a page that could not be scraped, even after retrying.
+
+Author: Ethan Henderson
+https://github.com/ethan626
+
+"""
+
+FIELDS = ("title", "price", "hood", "page_text", "email", "phone", "url", "updated", "posted")
+
+HEADERS = ["Title", "Price", "Location", "Posting Information", "Email", "Phone", "Url", "Updated", "Posted"]
+
+
+class Ad:
+    """ One scraped ad. Also behaves like the list of its fields, in the order of FIELDS.
+        contact is the url of the ad's reply page while its email and phone are still to be looked up, see resolve_contacts. """
+
+    __slots__ = FIELDS + ("contact",)
+
+    def __init__(self, title=None, price=None, hood=None, page_text=None, email=None, phone=None,
+                 url=None, updated=None, posted=None):
+        self.title = title
+        self.price = price
+        self.hood = hood
+        self.page_text = page_text
+        self.email = email
+        self.phone = phone
+        self.url = url
+        self.updated = updated
+        self.posted = posted
+        self.contact = None
+
+    def __iter__(self):
+        return (getattr(self, field) for field in FIELDS)
+
+    def __len__(self):
+        return len(FIELDS)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self)[i]
+
+        return getattr(self, FIELDS[i])
+
+    def __eq__(self, other):
+        return isinstance(other, Ad) and list(self) == list(other)
+
+    def __repr__(self):
+        return "Ad({})".format(", ".join("{}={!r}".format(field, value) for field, value in zip(FIELDS, self)))
+
+    def __getstate__(self):     # Ads cross process boundaries when pages are parsed in a pool, and are spilled to disk by Sorter
+        return list(self) + [self.contact]
+
+    def __setstate__(self, state):
+        for field, value in zip(FIELDS + ("contact",), state):
+            setattr(self, field, value)
+
+        if len(state) == len(FIELDS):
+            self.contact = None
+
+
+def sortable(value):
+    """ Makes values of one field comparable with each other. Dates lose their time zone so naive and aware dates mix. """
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.replace(tzinfo=None)
+
+    return value
+
+
+def sort_order(values, reverse=False):
+    """ Returns the indices that sort values. Missing (None) values always go last, whichever way the rest are sorted. """
+    present = [i for i, value in enumerate(values) if value is not None]
+    present.sort(key=lambda i: sortable(values[i]), reverse=reverse)
+
+    return present + [i for i, value in enumerate(values) if value is None]
+
+
+class AdBatch:
+    """ Ads stored column by column. Prices are kept in a float array, with NaN for a missing price. """
+
+    def __init__(self, ads=()):
+        self.columns = {field: array("d") if field == "price" else [] for field in FIELDS}
+        self.extend(ads)
+
+    def append(self, ad):
+        for field, value in zip(FIELDS, ad):
+            if field == "price":
+                value = float("nan") if value is None else value
+
+            self.columns[field].append(value)
+
+    def extend(self, ads):
+        for ad in ads:
+            self.append(ad)
+
+    def __len__(self):
+        return len(self.columns["title"])
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def column(self, field):
+        """ Returns a field's values for every ad, None where it is missing. """
+        if field == "price":
+            return [None if isnan(price) else price for price in self.columns["price"]]
+
+        return self.columns[field]
+
+    def __getitem__(self, i):
+        ad = Ad(*(self.columns[field][i] for field in FIELDS))
+        ad.price = None if isnan(ad.price) else ad.price
+
+        return ad
+
+    def __iter__(self):
+        return (Ad(*values) for values in zip(*(self.column(field) for field in FIELDS)))
+
+    def sort(self, field, reverse=False):
+        """ Sorts the batch by field, or by an Expression, in place. Ads missing the field always go last. """
+        order = sort_order([field(ad) for ad in self] if callable(field) else self.column(field), reverse=reverse)
+
+        for name, column in self.columns.items():
+            self.columns[name] = (array("d", (column[i] for i in order)) if name == "price"
+                                  else [column[i] for i in order])
+
+
+class Failure:
+    """ A page that could not be scraped. stage is the kind of page, one of search, ad or contact. """
+
+    __slots__ = ("url", "stage", "error", "status")
+
+    def __init__(self, url, stage, error, status=None):
+        self.url = url
+        self.stage = stage
+        self.error = error      # The error's type and message, for example "ClientResponseError: 404, message='Not Found'"
+        self.status = status    # The http status, if the server answered
+
+    @classmethod
+    def from_exception(cls, url, stage, exception):
+        message = str(exception)
+        error = type(exception).__name__ + (": " + message if message else "")  # Timeouts have no message
+
+        return cls(url, stage, error, getattr(exception, "status", None))
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return "Failure({})".format(", ".join("{}={!r}".format(name, getattr(self, name)) for name in self.__slots__))
@@ -0,0 +1,302 @@
+#!/bin/python
+import argparse
+import asyncio
+import configparser
+import json
+import signal
+import time
+from os.path import expanduser
+
+from aiohttp import web
+
+from craigraker_expr import compile_expression
+from craigraker_functions import get_loop, iter_scrape, new_job, failure_log, close_all, configure_from, get_stats, AdStore, \
+    row_filter, search_filters, record_failure
+from craigraker_output import json_value
+from craigraker_results import FIELDS
+from craigraker_sort import Sorter
+
+"""
+
+Craigraker! A really cool Craigslist scraper!
+
+The serve subcommand, a long running craigraker that takes searches over a local JSON API.
+One event loop, connection pool, scheduler and response cache stay alive between searches,
+so a search run from cron is a cheap request instead of a cold start:
+
+python craigraker.py serve --socket /tmp/craigraker.sock
+curl -N --unix-socket /tmp/craigraker.sock -d '{"query": "bike", "maxresults": 240}' http://localhost/scrape
+
+Results are streamed back one json object per line as they are scraped, then a last line
+{"done": true, ...} with the count and the pages that could not be scraped. Clients asking for
+the same search while it is running share the one scrape, late comers get the results so far first.
+
+Author: Ethan Henderson
+https://github.com/ethan626
+
+"""
+
+OPTIONS = {"city": str, "sublocation": str, "section": str, "query": str, "maxresults": int, "firstpage": bool,
+           "verbose": bool, "ignorewanted": bool, "sort": str, "reverse": bool, "filter": str, "minprice": int, "maxprice": int,
+           "postedtoday": bool, "hasimage": bool, "titleonly": bool}
+
+
+def option_value(name, value):
+    """ Checks the type of an option of a search. Query string values are all text, so they are converted. """
+    kind = OPTIONS[name]
+
+    if isinstance(value, str) and kind is bool:
+        if value.lower() not in ("true", "false", "1", "0", "yes", "no"):
+            raise ValueError("{} must be true or false".format(name))
+
+        return value.lower() in ("true", "1", "yes")
+
+    if isinstance(value, str) and kind is int:
+        try:
+            return int(value)
+
+        except ValueError:
+            raise ValueError("{} must be a number".format(name))
+
+    if not isinstance(value, kind) or (kind is int and isinstance(value, bool)):
+        raise ValueError("{} must be {}".format(name, {str: "text", int: "a number", bool: "true or false"}[kind]))
+
+    return value
+
+
+def search_options(options, defaults):
+    """ Returns the checked options of a search, filled in from defaults. Raises ValueError for a bad search. """
+    unknown = sorted(set(options) - set(OPTIONS))
+
+    if unknown:
+        raise ValueError("Unknown options {}".format(", ".join(unknown)))
+
+    options = dict(defaults, **{name: option_value(name, value) for name, value in options.items() if value is not None})
+
+    for name in ("sort", "filter"):  # A field or an expression, see craigraker_expr.py
+        if options.get(name) and options[name] not in FIELDS:
+            compile_expression(options[name])
+
+    if options.get("filter") and compile_expression(options["filter"]).late and not options["verbose"]:
+        raise ValueError("filter uses fields of the ad page, which needs verbose")
+
+    return options
+
+
+class SharedScrape:
+    """ One running search, and the results it has found so far. Any number of clients follow it. """
+
+    def __init__(self, job, dedupe=None, store=None):
+        self.job = job
+        self.results = []
+        self.failures = []
+        self.done = False
+        self.followers = 0
+        self.changed = asyncio.Condition()
+        self.task = asyncio.ensure_future(self.run(dedupe, store))
+
+    async def run(self, dedupe, store):
+        failure_log.set(self.failures)  # This task's own copy of the context, so failures stay with this search
+        job = self.job
+        row_filter.set(compile_expression(job["where"]) if job["where"] else None)
+
+        try:
+            async for result in iter_scrape(job["search_url"], job["local_cl_url"], job["query"], max_results=job["max_results"],
+                                            verbose=job["verbose"], wanted=job["wanted"], dedupe=dedupe, filters=job["filters"]):
+                self.results.append(result)
+
+                if store is not None:
+                    store.write(result, source=job["name"])
+
+                async with self.changed:
+                    self.changed.notify_all()
+
+        except Exception as e:     # Counted and kept with this search's failures, with a traceback under DEBUG
+            record_failure(job["search_url"], "search", e, "Could not scrape {}".format(job["search_url"]))
+
+        finally:
+            self.done = True
+
+            if store is not None:
+                store.flush()
+
+            async with self.changed:
+                self.changed.notify_all()
+
+    async def follow(self):
+        """ Yields every result of the search, from the first, until it is done. """
+        self.followers += 1
+        seen = 0
+
+        try:
+            while True:
+                async with self.changed:
+                    await self.changed.wait_for(lambda: seen < len(self.results) or self.done)
+
+                while seen < len(self.results):
+                    yield self.results[seen]
+                    seen += 1
+
+                if self.done:
+                    return
+
+        finally:
+            self.followers -= 1
+
+
+class Server:
+    """ The searches running in the daemon, keyed by what they search for. """
+
+    def __init__(self, defaults, dedupe=None, store=None):
+        self.defaults = defaults
+        self.dedupe = dedupe
+        self.store = store
+        self.running = {}
+        self.started = time.monotonic()
+
+    def scrape(self, options):
+        """ Returns the SharedScrape for a search, joining the one already running if there is one. """
+        where = options.get("filter") or None
+        filters = search_filters(min_price=options.get("minprice"), max_price=options.get("maxprice"),
+                                 posted_today=options.get("postedtoday", False), has_image=options.get("hasimage", False),
+                                 title_only=options.get("titleonly", False), where=compile_expression(where) if where else None)
+        job = new_job(options.get("query"), options["city"], options["sublocation"], options["section"] or "sss?",
+                      options.get("query"), max_results=options["maxresults"], firstpage=options["firstpage"],
+                      verbose=options["verbose"], wanted=options["ignorewanted"], filters=filters, where=where)
+        key = (job["search_url"], job["query"], job["max_results"], job["verbose"], job["wanted"], tuple(sorted(filters.items())),
+               where)
+
+        if key in self.running:
+            get_stats().count("coalesced")
+            return self.running[key]
+
+        shared = SharedScrape(job, dedupe=self.dedupe, store=self.store)
+        self.running[key] = shared
+        shared.task.add_done_callback(lambda task: self.running.pop(key, None))
+
+        return shared
+
+    async def handle_scrape(self, request):
+        options = dict(request.query)
+
+        try:
+            if request.can_read_body:
+                body = await request.json()
+
+                if not isinstance(body, dict):
+                    raise ValueError("The search must be a json object")
+
+                options.update(body)
+
+            options = search_options(options, self.defaults)
+
+        except ValueError as e:     # Includes bad json
+            return web.json_response({"error": str(e)}, status=400)
+
+        shared = self.scrape(options)
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+
+        sort = options.get("sort")
+        sorter = Sorter(sort if sort in FIELDS else compile_expression(sort), reverse=options.get("reverse", False)) if sort else None
+        count = 0
+
+        def line(value):
+            return (json.dumps(value) + "\n").encode()
+
+        try:
+            async for result in shared.follow():
+                if sorter is not None:
+                    sorter.add(result)
+                    continue
+
+                await response.write(line(dict(zip(FIELDS, map(json_value, result)))))
+                count += 1
+
+            for result in sorter if sorter is not None else ():
+                await response.write(line(dict(zip(FIELDS, map(json_value, result)))))
+                count += 1
+
+            await response.write(line({"done": True, "results": count, "failures": [f.as_dict() for f in shared.failures]}))
+            await response.write_eof()
+
+        except ConnectionResetError:    # The client went away, the search carries on for anyone else following it
+            pass
+
+        finally:
+            if sorter is not None:
+                sorter.close()
+
+        return response
+
+    async def handle_status(self, request):
+        return web.json_response({"uptime_seconds": round(time.monotonic() - self.started, 1),
+                                  "running": [{"search": shared.job["name"], "results": len(shared.results),
+                                               "followers": shared.followers} for shared in self.running.values()]})
+
+    async def handle_metrics(self, request):
+        return web.Response(text=get_stats().prometheus(), content_type="text/plain", charset="utf-8")
+
+    def app(self):
+        app = web.Application()
+        app.router.add_route("*", "/scrape", self.handle_scrape)
+        app.router.add_get("/status", self.handle_status)
+        app.router.add_get("/metrics", self.handle_metrics)
+
+        return app
+
+
+def serve_main(argv=None):
+    """ The serve subcommand. Runs until interrupted. """
+    parser = argparse.ArgumentParser(prog="craigraker serve", description="Take searches over a local JSON API")
+    parser.add_argument("--host", default="127.0.0.1", help="The address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="The port to listen on")
+    parser.add_argument("--socket", metavar="PATH", help="Listen on a unix socket at PATH instead of a port")
+    parser.add_argument("--store", help="Keep every ad in the local store, to search later with craigraker query", action="store_true")
+    args = parser.parse_args(argv)
+
+    config = configparser.ConfigParser()
+    config.read(expanduser("~/.craigrakerrc"))  # Settings and default search options, like craigraker.py
+
+    try:
+        configure_from(config)
+        store = AdStore() if args.store or config["DEFAULT"].getboolean("store", False) else None
+
+    except ValueError as e:
+        parser.error(str(e))
+
+    defaults = {"city": config["DEFAULT"].get("city", "seattle"), "sublocation": config["DEFAULT"].get("sublocation", ""),
+                "section": config["DEFAULT"].get("section", ""), "maxresults": config["DEFAULT"].getint("maxresults", 2500),
+                "firstpage": config["DEFAULT"].getboolean("firstpage", False), "verbose": False, "ignorewanted": False}
+    server = Server(defaults, dedupe=None if config["DEFAULT"].getboolean("dedupe", True) else False, store=store)
+
+    loop = get_loop()
+    runner = web.AppRunner(server.app())
+    loop.run_until_complete(runner.setup())
+    site = web.UnixSite(runner, args.socket) if args.socket else web.TCPSite(runner, args.host, args.port)
+    loop.run_until_complete(site.start())
+    print("Serving on {}".format(args.socket or "http://{}:{}".format(args.host, args.port)), flush=True)
+
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+
+    try:
+        loop.run_forever()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        loop.run_until_complete(runner.cleanup())
+
+        tasks = [shared.task for shared in server.running.values()]
+
+        for task in tasks:
+            task.cancel()
+
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+        if store is not None:
+            store.close()
+
+        close_all()
+        loop.close()
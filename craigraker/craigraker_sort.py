@@ -0,0 +1,170 @@
+#!/bin/python
+import heapq
+import pickle
+from datetime import datetime
+from sys import getsizeof
+from tempfile import TemporaryFile
+
+from craigraker_results import sortable
+
+"""
+
+Craigraker! A really cool Craigslist scraper!
+
+The sort stage used by craigraker.py. Ads are added one at a time as they are scraped, and come back out
+sorted once every ad is in. Each ad's sort key is computed once, when it is added, and ads missing the field
+always go last whichever way the rest are sorted.
+
+With a limit only the best limit ads are kept, in a bounded heap. Otherwise, once the ads held pass the
+memory budget they are sorted and written to a temporary file, and the files are merged at the end.
+
+Author: Ethan Henderson
+https://github.com/ethan626
+
+"""
+
+EPOCH = datetime(1970, 1, 1)
+
+MISSING = (1, 0)    # Sorts after every (0, value) key
+
+ROW_OVERHEAD = 200  # Rough bytes an Ad and its list entry take, on top of its values
+
+SPILL_CHUNK = 1000  # Ads pickled together when writing a sorted run to disk
+
+
+class Descending:
+    """ Wraps a value so that it sorts in the opposite order, for values that can't simply be negated. """
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def sort_key(field, reverse=False, ad=None):
+    """ Returns a function giving the sort key for field of an ad, or of an item holding an ad (ad(item) returns it).
+        field may also be an Expression from craigraker_expr.py, computed for each ad.
+        Dates and prices become plain floats, so keys compare quickly and mixed naive and aware dates never meet. """
+    ad = ad or (lambda item: item)
+
+    def key(item):
+        value = field(ad(item)) if callable(field) else getattr(ad(item), field)
+
+        if value is None:
+            return MISSING
+
+        if isinstance(value, datetime):
+            value = (sortable(value) - EPOCH).total_seconds()
+
+        if isinstance(value, (int, float)):
+            return 0, -value if reverse else value
+
+        return 0, Descending(value) if reverse else value
+
+    return key
+
+
+class Worst:
+    """ A heap entry that puts the worst kept ad on top of the heap, so it is the one replaced. """
+
+    __slots__ = ("key", "count", "item")
+
+    def __init__(self, key, count, item):
+        self.key = key
+        self.count = count      # Ties go to the ad added first
+        self.item = item
+
+    def __lt__(self, other):
+        return (other.key, other.count) < (self.key, self.count)
+
+
+class Sorter:
+    """ Sorts a stream of ads by field, or by an Expression. add() each ad, then iterate over the Sorter for the sorted ads.
+
+        Kwargs:
+            reverse -- Sort from largest to smallest. Ads missing the field go last either way.
+            limit -- Only keep the first limit ads in sorted order.
+            memory -- Megabytes of ads to hold before sorted runs are spilled to disk.
+            ad -- Returns the ad from an item, when the items added hold an ad rather than being one.
+    """
+
+    def __init__(self, field, reverse=False, limit=None, memory=256, ad=None):
+        self.key = sort_key(field, reverse=reverse, ad=ad)
+        self.ad = ad or (lambda item: item)
+        self.limit = limit
+        self.budget = memory * 1024 * 1024
+        self.count = 0
+        self.held = []          # The ads in memory, a heap of Worst entries when limited
+        self.held_bytes = 0
+        self.runs = []          # Temporary files, each holding a sorted run of ads
+
+    def add(self, item):
+        self.count += 1
+
+        if self.limit:
+            entry = Worst(self.key(item), self.count, item)
+
+            if len(self.held) < self.limit:
+                heapq.heappush(self.held, entry)
+
+            elif self.held[0] < entry:  # Better than the worst ad kept
+                heapq.heapreplace(self.held, entry)
+
+            return
+
+        self.held.append(item)
+        self.held_bytes += ROW_OVERHEAD + sum(getsizeof(value) for value in self.ad(item))
+
+        if self.held_bytes > self.budget:
+            self.spill()
+
+    def spill(self):
+        """ Sorts the ads held in memory and writes them to a temporary file. """
+        self.held.sort(key=self.key)
+        run = TemporaryFile()
+
+        for i in range(0, len(self.held), SPILL_CHUNK):
+            pickle.dump(self.held[i:i + SPILL_CHUNK], run, protocol=pickle.HIGHEST_PROTOCOL)
+
+        run.seek(0)
+        self.runs.append(run)
+        self.held, self.held_bytes = [], 0
+
+    def __len__(self):
+        return min(self.count, self.limit) if self.limit else self.count
+
+    def __iter__(self):
+        if self.limit:
+            return (entry.item for entry in sorted(self.held, key=lambda entry: (entry.key, entry.count)))
+
+        if not self.runs:
+            self.held.sort(key=self.key)
+            return iter(self.held)
+
+        if self.held:
+            self.spill()
+
+        return heapq.merge(*[read_run(run) for run in self.runs], key=self.key)  # Earlier runs win ties, keeping the sort stable
+
+    def close(self):
+        """ Deletes the temporary files. """
+        for run in self.runs:
+            run.close()
+
+        self.runs = []
+
+
+def read_run(run):
+    """ Yields the ads in a sorted run written by Sorter.spill. """
+    while True:
+        try:
+            yield from pickle.load(run)
+
+        except EOFError:
+            return
@@ -0,0 +1,233 @@
+#!/bin/python
+import json
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from os import replace
+
+"""
+
+Craigraker! A really cool Craigslist scraper!
+
+Counters and latency histograms for a run, so a slow run can be pinned on the network,
+parsing, date parsing or contact lookups. craigraker_functions.py records into the shared
+Stats from get_stats(), and craigraker.py reports them with --stats, --prometheus and --metricsport.
+
+Metrics have a name and an optional label, for example the "fetch" timer is labelled with the
+kind of page fetched (search, ad or reply). Pages parsed in worker processes (--parseworkers)
+count towards parse times, but what happens inside the workers, such as date parsing, is not counted.
+
+Author: Ethan Henderson
+https://github.com/ethan626
+
+"""
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # Seconds
+
+_stats = None
+
+
+class Histogram:
+    """ Counts observations into the fixed BUCKETS, like a Prometheus histogram. """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # The last bucket is everything over the biggest bound
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        """ Estimates a percentile by interpolating within the bucket it falls in. """
+        wanted = fraction * self.count
+        seen = 0
+
+        for lower, upper, count in zip((0,) + BUCKETS, BUCKETS, self.counts):
+            if count and seen + count >= wanted:
+                return min(self.max, lower + (upper - lower) * (wanted - seen) / count)
+
+            seen += count
+
+        return self.max
+
+    def summary(self):
+        return {"count": self.count,
+                "total_seconds": round(self.sum, 4),
+                "mean_ms": round(self.sum / self.count * 1000, 2) if self.count else 0,
+                "p50_ms": round(self.percentile(0.5) * 1000, 2),
+                "p99_ms": round(self.percentile(0.99) * 1000, 2),
+                "max_ms": round(self.max * 1000, 2)}
+
+
+class Stats:
+    """ The counters and timers of one run. """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.counters = defaultdict(int)        # (name, label) -> count
+        self.timers = defaultdict(Histogram)    # (name, label) -> Histogram of seconds
+
+    def count(self, name, label=None, n=1):
+        self.counters[name, label] += n
+
+    def observe(self, name, seconds, label=None):
+        self.timers[name, label].observe(seconds)
+
+    @contextmanager
+    def timer(self, name, label=None):
+        """ Times the with block, which may await. Failed blocks are timed too. """
+        started = time.perf_counter()
+
+        try:
+            yield
+
+        finally:
+            self.observe(name, time.perf_counter() - started, label)
+
+    def summary(self):
+        """ Returns everything recorded as a dict ready for json. Labelled metrics are keyed name:label. """
+        def key(name, label):
+            return name if label is None else "{}:{}".format(name, label)
+
+        return {"elapsed_seconds": round(time.monotonic() - self.started, 3),
+                "counters": {key(*k): v for k, v in sorted(self.counters.items(), key=str)},
+                "timers": {key(*k): h.summary() for k, h in sorted(self.timers.items(), key=str)}}
+
+    def prometheus(self):
+        """ Returns everything recorded in the Prometheus text exposition format. """
+        lines = []
+
+        def labels(label, **extra):
+            pairs = ([("kind", label)] if label is not None else []) + list(extra.items())
+            return "{" + ",".join('{}="{}"'.format(k, v) for k, v in pairs) + "}" if pairs else ""
+
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append("# TYPE craigraker_{}_total counter".format(name))
+            lines.extend("craigraker_{}_total{} {}".format(name, labels(label), value)
+                         for (n, label), value in sorted(self.counters.items(), key=str) if n == name)
+
+        for name in sorted({name for name, _ in self.timers}):
+            lines.append("# TYPE craigraker_{}_seconds histogram".format(name))
+
+            for (n, label), histogram in sorted(self.timers.items(), key=str):
+                if n != name:
+                    continue
+
+                cumulative = 0
+
+                for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append("craigraker_{}_seconds_bucket{} {}".format(name, labels(label, le=bound), cumulative))
+
+                lines.append("craigraker_{}_seconds_sum{} {}".format(name, labels(label), histogram.sum))
+                lines.append("craigraker_{}_seconds_count{} {}".format(name, labels(label), histogram.count))
+
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path):
+        """ Writes the summary to path, or prints it if path is "-". """
+        text = json.dumps(self.summary(), indent=2)
+
+        if path == "-":
+            print(text)
+            return
+
+        with open(path, "w") as f:
+            f.write(text + "\n")
+
+    def write_prometheus(self, path):
+        """ Writes the Prometheus text to path. The file is replaced in one step, so a scraper never reads half of it. """
+        with open(path + ".tmp", "w") as f:
+            f.write(self.prometheus())
+
+        replace(path + ".tmp", path)
+
+
+def get_stats():
+    """ Returns the shared Stats, creating it on first use. """
+    global _stats
+
+    if _stats is None:
+        _stats = Stats()
+
+    return _stats
+
+
+def timed(name):
+    """ Decorates a coroutine function so every call to it is timed as name in the shared Stats. """
+    def decorator(function):
+        @wraps(function)
+        async def wrapper(*args, **kwargs):
+            with get_stats().timer(name):
+                return await function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def reset_stats():
+    """ Starts a new Stats, for example between benchmark runs. """
+    global _stats
+    _stats = Stats()
+
+
+async def start_metrics_server(port, host="127.0.0.1"):
+    """ Serves the Prometheus text on http://host:port/metrics from the running event loop. Returns the runner to clean up. """
+    from aiohttp import web     # Only the server needs aiohttp.web
+
+    async def metrics(request):
+        return web.Response(text=get_stats().prometheus(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+    return runner
+
+
+@contextmanager
+def profiled(path):
+    """ Profiles the with block. Writes pyinstrument's html report if path ends in .html (needs pyinstrument),
+        otherwise cProfile stats that can be read with python -m pstats path. """
+    if path.endswith(".html"):
+        try:
+            from pyinstrument import Profiler
+
+        except ImportError:
+            raise ValueError("Writing an html profile needs pyinstrument, install it with pip install pyinstrument")
+
+        profiler = Profiler(async_mode="enabled")
+        profiler.start()
+
+        try:
+            yield
+
+        finally:
+            profiler.stop()
+
+            with open(path, "w") as f:
+                f.write(profiler.output_html())
+
+        return
+
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    try:
+        yield
+
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
@@ -0,0 +1,213 @@
+#!/bin/python
+import argparse
+import sqlite3
+import sys
+from datetime import datetime, time
+from os import makedirs
+from os.path import dirname, expanduser
+
+from craigraker_output import Writer, open_writer, print_result
+from craigraker_results import Ad, FIELDS, HEADERS, sortable
+
+"""
+
+Craigraker! A really cool Craigslist scraper!
+
+A local store of scraped ads, so follow-up questions can be answered without scraping again.
+Ads are kept in SQLite, with indexes on price, neighborhood and dates, and a full-text (FTS5) index
+over the title, neighborhood and ad text. craigraker.py writes into it with --store, and it is
+searched with the query subcommand, which never touches the network:
+
+python craigraker.py query "road bike" --maxprice 500 --since 2019-01-01 --sort price
+
+Author: Ethan Henderson
+https://github.com/ethan626
+
+"""
+
+STORE_PATH = "~/.cache/craigraker/ads.sqlite3"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ads (id INTEGER PRIMARY KEY, url TEXT UNIQUE, title TEXT, price REAL, hood TEXT, page_text TEXT,
+                                email TEXT, phone TEXT, updated TEXT, posted TEXT, search TEXT, scraped TEXT);
+CREATE INDEX IF NOT EXISTS ads_price ON ads (price);
+CREATE INDEX IF NOT EXISTS ads_hood ON ads (hood COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS ads_posted ON ads (posted);
+CREATE INDEX IF NOT EXISTS ads_updated ON ads (updated);
+CREATE VIRTUAL TABLE IF NOT EXISTS ads_text USING fts5 (title, hood, page_text, content=ads, content_rowid=id);
+CREATE TRIGGER IF NOT EXISTS ads_insert AFTER INSERT ON ads BEGIN
+    INSERT INTO ads_text (rowid, title, hood, page_text) VALUES (new.id, new.title, new.hood, new.page_text);
+END;
+CREATE TRIGGER IF NOT EXISTS ads_delete AFTER DELETE ON ads BEGIN
+    INSERT INTO ads_text (ads_text, rowid, title, hood, page_text) VALUES ('delete', old.id, old.title, old.hood, old.page_text);
+END;
+CREATE TRIGGER IF NOT EXISTS ads_update AFTER UPDATE ON ads BEGIN
+    INSERT INTO ads_text (ads_text, rowid, title, hood, page_text) VALUES ('delete', old.id, old.title, old.hood, old.page_text);
+    INSERT INTO ads_text (rowid, title, hood, page_text) VALUES (new.id, new.title, new.hood, new.page_text);
+END;
+"""
+
+# A rescrape without --verbose has no ad text or contact details, so it keeps the ones already stored
+UPSERT = """
+INSERT INTO ads (url, title, price, hood, page_text, email, phone, updated, posted, search, scraped)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (url) DO UPDATE SET title = excluded.title, price = excluded.price, hood = excluded.hood,
+    page_text = coalesce(excluded.page_text, page_text), email = coalesce(excluded.email, email),
+    phone = coalesce(excluded.phone, phone), updated = excluded.updated, posted = coalesce(excluded.posted, posted),
+    search = excluded.search, scraped = excluded.scraped
+"""
+
+SORTS = {"price": "ads.price", "hood": "ads.hood COLLATE NOCASE", "posted": "ads.posted", "updated": "ads.updated",
+         "rank": "bm25(ads_text)"}
+
+
+def stored_date(value):
+    """ Dates are stored as naive ISO text, so they sort and compare as text. """
+    return sortable(value).isoformat(" ") if isinstance(value, datetime) else value
+
+
+def match_terms(text):
+    """ Turns free text into an FTS5 query matching every word, so quotes and operators in it are taken literally. """
+    return " ".join('"{}"'.format(word.replace('"', '""')) for word in text.split())
+
+
+class AdStore(Writer):
+    """ The store, opened at path. Ads written to it are upserted by url in batches. """
+
+    def __init__(self, path=STORE_PATH, batch_size=500):
+        super().__init__(expanduser(path), batch_size=batch_size, tagged=True)
+        makedirs(dirname(self.path), exist_ok=True)
+
+        try:
+            self.db = sqlite3.connect(self.path)
+            self.db.executescript(SCHEMA)
+
+        except sqlite3.OperationalError as e:  # An sqlite built without FTS5
+            raise ValueError("Could not open the ad store {}: {}".format(self.path, e))
+
+    def write_rows(self, rows):
+        scraped = datetime.now().isoformat(" ", "seconds")
+        ads = [dict(zip(("search",) + FIELDS, row)) for row in rows]  # Rows start with the search, see Writer
+
+        self.db.executemany(UPSERT, [(ad["url"], ad["title"], ad["price"], ad["hood"], ad["page_text"], ad["email"], ad["phone"],
+                                      stored_date(ad["updated"]), stored_date(ad["posted"]), ad["search"], scraped)
+                                     for ad in ads if ad["url"] is not None])
+        self.db.commit()
+
+    def query(self, text=None, min_price=None, max_price=None, hood=None, since=None, until=None, search=None,
+              sort=None, reverse=False, limit=None):
+        """ Returns the stored ads matching every condition given, as Ads.
+
+            Kwargs:
+                text -- words that must all appear in the title, neighborhood or ad text.
+                min_price, max_price -- the price range.
+                hood -- the neighborhood, ignoring case.
+                since, until -- the range of the date posted, or updated for ads scraped without --verbose.
+                search -- the search the ads were scraped by, the query or the --batch job name.
+                sort -- one of SORTS, by default the best text matches first or else the most recent.
+                limit -- the most ads to return.
+        """
+        tables, conditions, params = "ads", [], []
+
+        if text:
+            tables += " JOIN ads_text ON ads_text.rowid = ads.id"
+            conditions.append("ads_text MATCH ?")
+            params.append(match_terms(text))
+
+        for condition, value in (("ads.price >= ?", min_price), ("ads.price <= ?", max_price),
+                                 ("ads.hood = ? COLLATE NOCASE", hood), ("ads.search = ?", search),
+                                 ("coalesce(ads.posted, ads.updated) >= ?", stored_date(since)),
+                                 ("coalesce(ads.posted, ads.updated) <= ?", stored_date(until))):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+
+        sort = sort or ("rank" if text else "posted")
+
+        if sort == "rank" and not text:
+            raise ValueError("Sorting by rank needs words to search for")
+
+        order = SORTS[sort] if sort != "posted" else "coalesce(ads.posted, ads.updated)"
+        descending = (sort in ("posted", "updated")) != reverse  # Dates newest first
+        sql = "SELECT {} FROM {}{} ORDER BY {} IS NULL, {} {}{}".format(  # Missing values go last
+            ", ".join("ads." + field for field in FIELDS), tables, " WHERE " + " AND ".join(conditions) if conditions else "",
+            order, order, "DESC" if descending else "ASC", " LIMIT ?" if limit else "")
+
+        return [stored_ad(row) for row in self.db.execute(sql, params + ([limit] if limit else []))]
+
+    def __len__(self):
+        return self.db.execute("SELECT count(*) FROM ads").fetchone()[0]
+
+    def close(self):
+        super().close()
+        self.db.close()
+
+
+def stored_ad(row):
+    """ Builds an Ad from a row of the ads table, in the order of FIELDS. """
+    ad = Ad(*row)
+    ad.updated = datetime.fromisoformat(ad.updated) if ad.updated else None
+    ad.posted = datetime.fromisoformat(ad.posted) if ad.posted else None
+
+    return ad
+
+
+def query_date(text):
+    """ argparse type for --since and --until, any date dateutil understands. """
+    from dateutil.parser import parse
+
+    try:
+        return parse(text)
+
+    except (ValueError, OverflowError):
+        raise argparse.ArgumentTypeError("{} is not a date".format(text))
+
+
+def query_main(argv=None):
+    """ The query subcommand, searches the store instead of craigslist. """
+    parser = argparse.ArgumentParser(prog="craigraker query", description="Search the ads stored by craigraker --store")
+    parser.add_argument("text", nargs="*", help="Words that must all appear in the title, location or text of the ad")
+    parser.add_argument("--minprice", type=float, help="The lowest price")
+    parser.add_argument("--maxprice", type=float, help="The highest price")
+    parser.add_argument("-l", "--location", help="Only ads in this location (neighborhood)")
+    parser.add_argument("--since", type=query_date, help="Only ads posted on or after this date")
+    parser.add_argument("--until", type=query_date, help="Only ads posted on or before this date")
+    parser.add_argument("--search", help="Only ads found by this search, the query or --batch job name it was scraped with")
+    parser.add_argument("--sort", choices=sorted(SORTS), help="What to sort by. Best text matches first when searching for words, \
+                                                              otherwise the most recent first")
+    parser.add_argument("-r", "--reverse", help="Reverse the sort", action="store_true")
+    parser.add_argument("-m", "--maxresults", type=int, help="The maximum number of results to display")
+    parser.add_argument("-c", "--color", help="Color the output - uses ansi colors.", action="store_true")
+    parser.add_argument("-F", "--file", help="Also write the results to this file")
+    parser.add_argument("--format", choices=["csv", "ndjson", "parquet"], help="The format of --file")
+    parser.add_argument("--store", default=STORE_PATH, help="The store to search")
+    args = parser.parse_args(argv)
+
+    if args.until and args.until.time() == time(0):  # A day rather than a moment, so include all of it
+        args.until = args.until.replace(hour=23, minute=59, second=59)
+
+    try:
+        store = AdStore(args.store)
+        results = store.query(" ".join(args.text) or None, min_price=args.minprice, max_price=args.maxprice, hood=args.location,
+                              since=args.since, until=args.until, search=args.search, sort=args.sort, reverse=args.reverse,
+                              limit=args.maxresults)
+        writer = open_writer(args.file, format=args.format) if args.file else None
+
+    except (ValueError, sqlite3.OperationalError) as e:
+        parser.error(str(e))
+
+    if results:
+        print(print_result(HEADERS, color=args.color))  # Headers for csv columns
+
+    for result in results:
+        print(print_result(result, color=args.color))
+
+    if writer:
+        writer.write_all(results)
+        writer.close()
+
+    store.close()
+
+
+if __name__ == "__main__":
+    query_main(sys.argv[1:])
@@ -0,0 +1,273 @@
+#!/bin/python
+import argparse
+import asyncio
+import configparser
+import os
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from os.path import abspath, dirname, expanduser, join
+
+from craigraker_expr import compile_expression
+from craigraker_functions import fetch, parse_async, scrape_ad_page, search_parameters, failure_log, get_loop, close_all, \
+    configure_from, get_stats, transient, backoff_delay, row_filter, keep
+from craigraker_index import Deduplicator, posting_id
+from craigraker_output import json_value
+from craigraker_queue import QUEUE_PATH, STALE_RUN, open_queue
+from craigraker_results import Failure
+from craigraker_store import stored_ad
+
+"""
+
+Craigraker! A really cool Craigslist scraper!
+
+Scraping spread over worker processes, on this machine or any machine that can reach the queue.
+The coordinator (craigraker.py --batch JOBFILE --queue QUEUE) puts each search on a work queue
+and collects the ads the workers find. Workers run the same fetching and parsing as craigraker.py:
+
+python craigraker.py worker --queue /shared/queue.sqlite3
+
+A search job fetches the first page of a search and adds a page job for each page after it.
+A page job parses its page into ads, and with verbose adds a detail job for each ad, to fetch its
+ad page and contact details. A detail job is only added once for each posting id in a run.
+
+The queues are in craigraker_queue.py. Jobs that fail are retried with backoff, and jobs whose
+worker was lost are taken again once their lease runs out.
+
+Author: Ethan Henderson
+https://github.com/ethan626
+
+"""
+
+STAGES = {"search": "search", "page": "search", "detail": "ad"}  # The Failure stage of each kind of job
+
+
+def ad_record(ad):
+    """ An Ad as json, in the order of FIELDS. stored_ad turns it back into an Ad. """
+    return [json_value(value) for value in ad]
+
+
+def found(job, ads):
+    """ The ads on a search page are finished, unless verbose when each needs a detail job to fetch its ad page.
+        Ads the job's filter expression turns down are left out as soon as it can tell. """
+    ads = keep(ads)
+
+    if not job["verbose"]:
+        return [("ad", {"search": job["name"], "ad": ad_record(ad)}) for ad in keep(ads, late=True)], []
+
+    return [], [("detail", posting_id(ad.url) if job["dedupe"] else None,  # The queue drops a posting id it already has
+                 {"search": job["name"], "local_cl_url": job["local_cl_url"], "where": job["where"], "ad": ad_record(ad)})
+                for ad in ads]
+
+
+async def run_search(job):
+    """ The first page of a search, which also gives the number of pages after it. """
+    params = search_parameters(job["query"], 1, job["filters"])[0]
+    response = await fetch(job["search_url"], params=params, hedge=True)
+    total_results, ads = await parse_async("first", response, wanted=job["wanted"], max_results=job["max_results"])
+    total_results = min(len(ads) if total_results is None else total_results, job["max_results"])
+
+    pages = [("page", None, dict(job, params=param, max_results=total_results - param["s"]))
+             for param in search_parameters(job["query"], total_results, job["filters"])[1:]]
+    results, details = found(job, ads)
+
+    return results, pages + details
+
+
+async def run_page(job):
+    response = await fetch(job["search_url"], params=job["params"], hedge=True)
+    ads = await parse_async("search", response, wanted=job["wanted"], max_results=job["max_results"])
+
+    return found(job, ads)
+
+
+async def run_detail(job):
+    ad = stored_ad(job["ad"])
+    ad.page_text, ad.posted, ad.email, ad.phone = await scrape_ad_page(ad.url, job["local_cl_url"], contact_info=True)
+
+    return [("ad", {"search": job["search"], "ad": ad_record(ad)}) for ad in keep([ad], late=True)], []
+
+
+JOBS = {"search": run_search, "page": run_page, "detail": run_detail}
+
+
+def job_url(kind, job):
+    """ The url a job scrapes, for its Failure. """
+    if kind == "detail":
+        return stored_ad(job["ad"]).url
+
+    return job["search_url"] + "?s={}".format(job["params"]["s"]) if kind == "page" else job["search_url"]
+
+
+async def run_job(queue, worker, id, kind, job, attempts):
+    """ Runs one job and completes it on the queue, or gives it back to be retried. """
+    failures = []               # Contact pages that could not be scraped, sent back with the results
+    failure_log.set(failures)
+
+    try:
+        row_filter.set(compile_expression(job["where"]) if job.get("where") else None)  # Compiled once per worker, not per job
+        results, jobs = await JOBS[kind](job)
+
+    except Exception as e:
+        # fetch has already retried anything transient, so only retry what another worker, later, might get
+        final = getattr(e, "status", None) is not None and not transient(e)
+        await queue.call(queue.fail, id, worker, Failure.from_exception(job_url(kind, job), STAGES[kind], e).error,
+                         retry_in=None if final else backoff_delay(attempts))
+        get_stats().count("job_failures", kind)
+        return
+
+    if await queue.call(queue.complete, id, worker, results + [("failure", failure.as_dict()) for failure in failures], jobs):
+        get_stats().count("jobs", kind)
+
+
+async def work(queue, worker=None, concurrency=20, lease=300, poll=1.0, exit_when_idle=False):
+    """ Takes jobs from the queue and runs up to concurrency of them at once. Polls every poll seconds when there is no work.
+        Leases are renewed while jobs run, so only the jobs of a worker that has stopped are taken again. """
+    worker = worker or "{}:{}".format(socket.gethostname(), os.getpid())
+    running = {}                # Job id -> task
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(lease / 3)
+
+            if running:
+                await queue.call(queue.extend, list(running), worker, lease)
+
+    beat = asyncio.ensure_future(heartbeat())
+
+    try:
+        while True:
+            job = await queue.call(queue.take, worker, lease) if len(running) < concurrency else None
+
+            if job is not None:
+                id = job[0]
+                running[id] = asyncio.ensure_future(run_job(queue, worker, *job))
+                running[id].add_done_callback(lambda task, id=id: running.pop(id, None))
+                continue
+
+            # Runs whose coordinator is gone are left out, or a crashed coordinator's jobs would keep workers up forever
+            if exit_when_idle and not running and not await queue.call(queue.pending, stale=STALE_RUN):
+                return
+
+            if running:
+                await asyncio.wait(list(running.values()), timeout=poll, return_when=asyncio.FIRST_COMPLETED)
+
+            else:
+                await asyncio.sleep(poll)
+
+    finally:                    # Jobs cut short are taken again once their leases run out
+        beat.cancel()
+
+        for task in running.values():
+            task.cancel()
+
+
+def submit(queue, jobs, dedupe=None):
+    """ Puts jobs from load_jobs on the queue as a new run. Returns the run. dedupe is False to keep duplicate ads. """
+    run = uuid.uuid4().hex
+    queue.put(run, [("search", None, dict(job, dedupe=dedupe is not False)) for job in jobs])
+
+    return run
+
+
+async def collect(queue, run, dedupe=None, poll=0.5):
+    """ Yields (job name, Ad) for every ad the workers find in run, like iter_batch, until every job is done.
+        Ads found by more than one search are only yielded once, unless dedupe is False. The run is touched every
+        STALE_RUN / 4 seconds, so workers know its coordinator is still there. """
+    dedupe = Deduplicator() if dedupe is None else dedupe or None
+    log = failure_log.get()
+    after = 0
+    touched = time.monotonic()
+
+    def failed(failure):
+        print("Could not scrape {}".format(failure.url))
+
+        if log is not None:
+            log.append(failure)
+
+    def first(ad):
+        if dedupe is None or dedupe.first(ad):
+            return True
+
+        get_stats().count("duplicates")
+        return False
+
+    try:
+        while True:
+            if time.monotonic() - touched > STALE_RUN / 4:
+                await queue.call(queue.touch, run)
+                touched = time.monotonic()
+
+            pending = await queue.call(queue.pending, run)   # Before reading the results, so the last ones are never missed
+
+            for after, kind, result in await queue.call(queue.results, run, after):
+                if kind == "failure":
+                    failed(Failure(**result))
+                    continue
+
+                ad = stored_ad(result["ad"])
+
+                if first(ad):
+                    yield result["search"], ad
+
+            if not pending:
+                break
+
+            await asyncio.sleep(poll)
+
+        for kind, job, error in await queue.call(queue.failed, run):
+            failed(Failure(job_url(kind, job), STAGES[kind], error))
+
+            if kind == "detail":    # Still an ad, just without its ad page
+                ad = stored_ad(job["ad"])
+
+                if first(ad):
+                    yield job["search"], ad
+
+    finally:
+        await queue.call(queue.forget, run)
+
+
+def start_workers(queue, count):
+    """ Starts count worker processes on this machine for the queue spec, that stop once it has no work. Returns the processes. """
+    script = join(dirname(abspath(__file__)), "craigraker.py")
+
+    return [subprocess.Popen([sys.executable, script, "worker", "--queue", queue, "--exitwhenidle"], stdout=subprocess.DEVNULL)
+            for _ in range(count)]
+
+
+def worker_main(argv=None):
+    """ The worker subcommand. Runs until interrupted, or with --exitwhenidle until the queue has no work. """
+    parser = argparse.ArgumentParser(prog="craigraker worker", description="Run jobs from a craigraker work queue")
+    parser.add_argument("--queue", default=QUEUE_PATH, help="The queue, an SQLite file or backend:location")
+    parser.add_argument("--concurrency", type=int, default=20, help="The most jobs to run at once")
+    parser.add_argument("--lease", type=float, default=300, help="Seconds before the jobs of a worker that stopped answering are \
+                                                                 given to another")
+    parser.add_argument("--attempts", type=int, default=3, help="How many times a job is tried before it is given up on")
+    parser.add_argument("--exitwhenidle", help="Stop once the queue has no work", action="store_true")
+    args = parser.parse_args(argv)
+
+    config = configparser.ConfigParser()
+    config.read(expanduser("~/.craigrakerrc"))  # Request limits and the like, as for craigraker.py
+
+    try:
+        configure_from(config)
+        queue = open_queue(args.queue, max_attempts=args.attempts)
+
+    except ValueError as e:
+        parser.error(str(e))
+
+    loop = get_loop()
+
+    try:
+        loop.run_until_complete(work(queue, concurrency=args.concurrency, lease=args.lease, exit_when_idle=args.exitwhenidle))
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        queue.close()
+        close_all()
+        loop.close()
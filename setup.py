@@ -13,5 +13,6 @@ setup(
     install_requires=["argparse", "configparser", "gooey",
                       "os", "math", "traceback", "asyncio",
                       "dateutil", "aiohttp", "bs4", "lxml",
-                      "termcolor"]
+                      "termcolor"],
+    extras_require={"parquet": ["pyarrow"], "profile": ["pyinstrument"]}
     )
@@ -0,0 +1,5 @@
+import sys
+from os.path import abspath, dirname, join
+
+# The craigraker modules import each other by their own names, as when craigraker.py is run from its directory
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), "craigraker"))
@@ -0,0 +1,98 @@
+from datetime import datetime
+
+import pytest
+
+from craigraker_expr import Expression, compile_expression
+from craigraker_functions import search_filters
+from craigraker_results import Ad
+
+
+def ad(**fields):
+    return Ad(**dict({"title": "Trek road bike", "price": 450.0, "hood": "Fremont", "updated": datetime(2019, 1, 2)}, **fields))
+
+
+@pytest.mark.parametrize("text", [
+    "__import__('os')",
+    "open('/etc/passwd')",
+    "title.__class__",
+    "title[0]",
+    "lower.__globals__",
+    "[x for x in title]",
+    "lambda: 1",
+    "price ** 1000000",
+    "exec('1')",
+    "lower(title, key=1)",
+    "x",
+    "(price",
+    "-" * 100000 + "price",
+    "not " * 50000 + "price",
+    "+".join(["price"] * 200000),
+    "-" * 900 + "price",
+    "+".join(["price"] * 150),
+])
+def test_rejected(text):
+    with pytest.raises(ValueError):
+        Expression(text)
+
+
+@pytest.mark.parametrize("text", ["len('ab' * 300000000) > 0", "3 * 'ab'", "[1] * 10", "(1, 2) * 3"])
+def test_repetition_rejected(text):
+    with pytest.raises(ValueError):
+        Expression(text)
+
+
+def test_repetition_of_fields_is_stopped_as_it_runs():
+    expression = Expression("len(title * round(price)) > 0")
+
+    assert expression(ad(price=3e9)) is None
+    assert not expression.test(ad(price=3e9))
+
+
+def test_numbers_still_multiply():
+    assert Expression("price * 2")(ad()) == 900.0
+
+
+def test_filter_and_sort():
+    assert Expression("price < 500 and 'trek' in lower(title)").test(ad())
+    assert not Expression("matches(title, 'gravel|cross')").test(ad())
+    assert Expression("updated > date('2019-01-01')").test(ad())
+    assert Expression("-price")(ad()) == -450.0
+
+
+def test_missing_fields_fail_the_filter():
+    assert not Expression("price < 500").test(ad(price=None))
+    assert Expression("price < 500")(ad(price=None)) is None
+
+
+def test_fields_late_and_contacts():
+    expression = Expression("price < 500 and 'x' in email")
+
+    assert expression.fields == ("email", "price")
+    assert expression.late and expression.contacts
+    assert not Expression("price < 500").late
+
+
+@pytest.mark.parametrize("text, bounds", [
+    ("price < 500", (None, 500)),
+    ("price >= 50 and price <= 500", (50, 500)),
+    ("50 < price < 99.5", (50, 100)),
+    ("price == 20", (20, 20)),
+    ("price > 10 and price > 30 and 'x' in title", (30, None)),
+    ("price < 10 or price > 100", (None, None)),
+    ("not price < 10", (None, None)),
+    ("price * 2 < 10", (None, None)),
+    ("'x' in title", (None, None)),
+])
+def test_price_range(text, bounds):
+    assert Expression(text).price_range() == bounds
+
+
+def test_price_range_pushed_into_search_filters():
+    assert search_filters(where=Expression("price < 500")) == {"max_price": 500}
+    assert search_filters(min_price=100, max_price=300, where=Expression("price > 50 and price < 200")) == \
+        {"min_price": 100, "max_price": 200}
+    assert search_filters(posted_today=True, has_image=True, title_only=True) == {"postedToday": 1, "hasPic": 1, "srchType": "T"}
+
+
+def test_compiled_once():
+    assert compile_expression("price < 1") is compile_expression("price < 1")
@@ -0,0 +1,139 @@
+import asyncio
+
+import pytest
+
+import craigraker_queue
+from craigraker_queue import SqliteQueue
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(craigraker_queue.time, "time", clock.time)
+    return clock
+
+
+@pytest.fixture
+def queue(tmp_path, clock):
+    queue = SqliteQueue(str(tmp_path / "queue.sqlite3"), max_attempts=3)
+    yield queue
+    queue.close()
+
+
+def test_take_and_complete(queue):
+    queue.put("run", [("search", None, {"n": 1})])
+    id, kind, payload, attempts = queue.take("a", lease=60)
+
+    assert (kind, payload, attempts) == ("search", {"n": 1}, 1)
+    assert queue.take("b", lease=60) is None
+    assert queue.complete(id, "a", results=[("ad", {"title": "bike"})], jobs=[("detail", "ad-1", {"n": 2})])
+    assert queue.results("run") == [(1, "ad", {"title": "bike"})]
+    assert queue.take("b", lease=60)[1:3] == ("detail", {"n": 2})
+
+
+def test_dedupe_keys(queue):
+    queue.put("run", [("detail", "ad-1", {}), ("detail", "ad-1", {}), ("search", None, {}), ("search", None, {})])
+    queue.put("other", [("detail", "ad-1", {})])
+
+    assert queue.pending("run") == 3
+    assert queue.pending("other") == 1
+
+
+def test_retry_then_fail(queue, clock):
+    queue.put("run", [("search", None, {})])
+
+    for attempt in range(1, 3):
+        id, _, _, attempts = queue.take("a", lease=60)
+        assert attempts == attempt
+        queue.fail(id, "a", "Timed out", retry_in=10)
+        assert queue.take("a", lease=60) is None    # Not before retry_in
+        clock.now += 11
+
+    id, _, _, attempts = queue.take("a", lease=60)
+    queue.fail(id, "a", "Timed out", retry_in=10)
+
+    assert attempts == 3
+    assert queue.pending("run") == 0
+    assert queue.failed("run") == [("search", {}, "Timed out")]
+
+
+def test_final_failure(queue):
+    queue.put("run", [("search", None, {})])
+    id = queue.take("a", lease=60)[0]
+    queue.fail(id, "a", "Not found")
+
+    assert queue.failed("run") == [("search", {}, "Not found")]
+
+
+def test_expired_lease(queue, clock):
+    queue.put("run", [("search", None, {})])
+    id = queue.take("a", lease=60)[0]
+    clock.now += 61
+
+    assert queue.take("b", lease=60)[0] == id
+    assert not queue.complete(id, "a", results=[("ad", {})])   # Too late, b has it now
+    assert queue.results("run") == []
+    assert queue.complete(id, "b", results=[("ad", {})])
+
+
+def test_extend(queue, clock):
+    queue.put("run", [("search", None, {})])
+    id = queue.take("a", lease=60)[0]
+    clock.now += 50
+    queue.extend([id], "a", lease=60)
+    clock.now += 50
+
+    assert queue.take("b", lease=60) is None
+    assert queue.complete(id, "a")
+
+
+def test_lost_job(queue, clock):
+    queue.put("run", [("search", None, {})])
+
+    for worker in "abc":
+        queue.take(worker, lease=60)
+        clock.now += 61
+
+    assert queue.take("d", lease=60) is None
+    assert queue.failed("run") == [("search", {}, "Its worker was lost too many times")]
+
+
+def test_pending_leaves_out_stale_runs(queue, clock):
+    queue.put("crashed", [("search", None, {})])
+    clock.now += 100
+    queue.put("live", [("search", None, {})])
+
+    assert queue.pending() == 2
+    assert queue.pending(stale=60) == 1
+
+    clock.now += 100
+    assert queue.pending(stale=60) == 0
+
+    queue.touch("live")
+    assert queue.pending(stale=60) == 1
+
+    queue.forget("live")
+    assert queue.pending(stale=60) == 0
+
+
+def test_call(queue):
+    queue.put("run", [("search", None, {"n": 1})])
+
+    async def take():
+        return await queue.call(queue.take, "a", lease=60)
+
+    loop = asyncio.new_event_loop()
+
+    try:
+        assert loop.run_until_complete(take())[1:3] == ("search", {"n": 1})
+
+    finally:
+        loop.close()
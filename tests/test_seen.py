@@ -0,0 +1,62 @@
+import asyncio
+
+import craigraker_functions
+from craigraker_expr import compile_expression
+from craigraker_functions import iter_ads, row_filter
+from craigraker_index import SeenIndex
+from craigraker_results import Ad
+
+
+def ads():
+    return [Ad(title="Ad {}".format(n), price=100.0 * n, url="http://cl/ad/{}.html".format(n), updated="2019-01-0{}".format(n))
+            for n in range(1, 4)]
+
+
+def scraped(index, results, verbose=True):
+    async def run():
+        return [result async for result in iter_ads(results, "http://cl", verbose=verbose, index=index)]
+
+    loop = asyncio.new_event_loop()
+
+    try:
+        return loop.run_until_complete(run())
+
+    finally:
+        loop.close()
+
+
+def test_failed_ad_pages_are_not_marked(tmp_path, monkeypatch):
+    revalidated = []
+
+    async def scrape_ad_page(url, local_cl_url, contact_info=False, params=None, lazy_contact=False, revalidate=False):
+        revalidated.append(revalidate)
+
+        if url.endswith("/2.html"):
+            raise OSError("Connection reset")
+
+        return "text", None, None, None
+
+    monkeypatch.setattr(craigraker_functions, "scrape_ad_page", scrape_ad_page)
+    index = SeenIndex("search", path=str(tmp_path / "seen.sqlite3"))
+    results = ads()
+    token = row_filter.set(compile_expression("'text' in page_text and price < 300"))
+
+    try:
+        kept = scraped(index, results)
+
+    finally:
+        row_filter.reset(token)
+
+    assert [result.title for result in kept] == ["Ad 1"]    # Ad 2 failed, Ad 3 was filtered out
+    assert revalidated == [True, True, True]
+    assert [index.changed(result.url, result.updated) for result in results] == [False, True, False]
+    index.close()
+
+
+def test_search_results_are_marked(tmp_path):
+    index = SeenIndex("search", path=str(tmp_path / "seen.sqlite3"))
+    results = ads()
+
+    assert len(scraped(index, results, verbose=False)) == 3
+    assert not any(index.changed(result.url, result.updated) for result in results)
+    index.close()